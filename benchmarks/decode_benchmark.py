@@ -0,0 +1,171 @@
+# A microbenchmark for the CBUS frame decoder, comparing the original if/elif decoder with the table-driven one in cbus_messages.
+# Run from the repository root with: poetry run python benchmarks/decode_benchmark.py
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+from can import Message
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from cbus_messages import CbusOpcode, decode_message
+
+
+# The original decoder, kept here (unchanged apart from being flattened into functions) as the "before" measurement.
+class LegacyFunction:
+
+    def __init__(self, number: int, state: int):
+        self.number = number
+        self.state = state
+
+
+def legacy_get_bit_position_for_function_number(function_number: int) -> int:
+    if function_number == 0:
+        return 4
+    elif function_number <= 4:
+        return function_number - 1
+    elif function_number <= 8:
+        return function_number - 5
+    elif function_number <= 12:
+        return function_number - 9
+    elif function_number <= 20:
+        return function_number - 13
+    elif function_number <= 28:
+        return function_number - 21
+
+
+def legacy_parse_functions(byte: int, first_function_number: int, n_functions: int) -> List[LegacyFunction]:
+    functions = []
+    for i in range(first_function_number, first_function_number + n_functions):
+        functions.append(LegacyFunction(i, (byte >> legacy_get_bit_position_for_function_number(i)) & 0x01))
+    return functions
+
+
+def legacy_get_speed(byte: int) -> int:
+    nmra_speed = byte & 0x7F
+    if nmra_speed == 0:
+        return 0
+    elif nmra_speed == 1:
+        return -1
+    else:
+        return nmra_speed - 1
+
+
+class LegacyMessage:
+
+    def __init__(self, can_message: Message):
+        self.id = can_message.arbitration_id
+        self.op_code = can_message.data[0]
+        if self.op_code != CbusOpcode.RLOC:
+            self.session_id = can_message.data[1]
+        if self.op_code == CbusOpcode.RLOC:
+            self.address = (can_message.data[1] & ~0xC0) * 256 + can_message.data[2]
+        elif self.op_code == CbusOpcode.DSPD:
+            self.direction = (can_message.data[2] & 0x80) >> 7
+            self.speed = legacy_get_speed(can_message.data[2])
+        elif self.op_code == CbusOpcode.PLOC:
+            self.address = (can_message.data[2] & ~0xC0) * 256 + can_message.data[3]
+            self.direction = (can_message.data[4] & 0x80) >> 7
+            self.speed = legacy_get_speed(can_message.data[4])
+            self.functions = []
+            self.functions.extend(legacy_parse_functions(can_message.data[5], 0, 5))
+            self.functions.extend(legacy_parse_functions(can_message.data[6], 5, 4))
+            self.functions.extend(legacy_parse_functions(can_message.data[7], 9, 4))
+        elif self.op_code == CbusOpcode.DFUN:
+            function_range = can_message.data[2]
+            logging.debug("Function range: %d", function_range)
+            if function_range == 1:
+                self.functions = legacy_parse_functions(can_message.data[3], 0, 5)
+            if function_range == 2:
+                self.functions = legacy_parse_functions(can_message.data[3], 5, 4)
+            if function_range == 3:
+                self.functions = legacy_parse_functions(can_message.data[3], 9, 4)
+            if function_range == 4:
+                self.functions = legacy_parse_functions(can_message.data[3], 13, 8)
+            if function_range == 5:
+                self.functions = legacy_parse_functions(can_message.data[3], 21, 8)
+
+
+def legacy_decode(message: Message, tracked_session: int):
+    if message.dlc > 0:
+        op_code = message.data[0]
+        logging.debug("Message Opcode: %s", op_code)
+        cbus_message = None
+        if op_code == CbusOpcode.RLOC:
+            cbus_message = LegacyMessage(message)
+        elif op_code == CbusOpcode.KLOC:
+            cbus_message = LegacyMessage(message)
+        elif op_code == CbusOpcode.DSPD:
+            cbus_message = LegacyMessage(message)
+        elif op_code == CbusOpcode.DFUN:
+            cbus_message = LegacyMessage(message)
+        elif op_code == CbusOpcode.PLOC:
+            cbus_message = LegacyMessage(message)
+        # The listener then threw away anything for another session.
+        if cbus_message is not None and getattr(cbus_message, "session_id", tracked_session) == tracked_session:
+            return cbus_message
+    return None
+
+
+def generate_frames(n_frames: int, n_sessions: int, seed: int, session_churn: bool = True) -> List[Message]:
+    """Generates a busy-layout mix of traffic: mostly DSPD and DFUN from every session, with the occasional other opcode.
+
+    Without session_churn, sessions are never ended or moved to another loco: KLOCs are replaced by DKEEPs, and session n's
+    PLOCs are always for address n, so a table primed with those sessions keeps them all."""
+    rng = random.Random(seed)
+    frames = []
+    for _ in range(n_frames):
+        session = rng.randrange(1, n_sessions + 1)
+        roll = rng.random()
+        if roll < 0.60:
+            data = [CbusOpcode.DSPD, session, rng.randrange(256)]
+        elif roll < 0.90:
+            data = [CbusOpcode.DFUN, session, rng.randrange(1, 6), rng.randrange(256)]
+        elif roll < 0.94:
+            address_high, address_low = (0xC0 | rng.randrange(64), rng.randrange(256)) if session_churn else (0xC0, session)
+            data = [CbusOpcode.PLOC, session, address_high, address_low, rng.randrange(256), rng.randrange(32), rng.randrange(16), rng.randrange(16)]
+        elif roll < 0.96:
+            data = [CbusOpcode.RLOC, 0xC0 | rng.randrange(64), rng.randrange(256)]
+        elif roll < 0.98:
+            data = [CbusOpcode.KLOC if session_churn else CbusOpcode.DKEEP, session]
+        else:
+            data = [0x90, 0, 1, 0, 2]     # ACON, which the decoder ignores.
+        frames.append(Message(arbitration_id=rng.randrange(128), data=data, is_extended_id=False))
+    return frames
+
+
+def measure(name: str, decode: Callable[[Message], object], frames: List[Message], repeats: int) -> float:
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for frame in frames:
+            decode(frame)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    frames_per_second = len(frames) / best
+    print(f"{name:<40} {frames_per_second:>14,.0f} frames/s")
+    return frames_per_second
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark CBUS frame decoding.")
+    parser.add_argument("--frames", type=int, default=200000, help="Number of frames to decode per run")
+    parser.add_argument("--sessions", type=int, default=8, help="Number of active sessions generating traffic")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of runs; the best is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # The hot path should not be paying for log output, so measure with debug logging disabled.
+    logging.basicConfig(level="WARNING")
+    frames = generate_frames(args.frames, args.sessions, args.seed)
+    tracked_session = 1
+    session_filter = frozenset((tracked_session,))
+
+    print(f"{args.frames} frames, {args.sessions} sessions, best of {args.repeats}")
+    before = measure("if/elif decoder (before)", lambda frame: legacy_decode(frame, tracked_session), frames, args.repeats)
+    after = measure("table decoder, no session filter", decode_message, frames, args.repeats)
+    filtered = measure("table decoder, session filter", lambda frame: decode_message(frame, session_filter), frames, args.repeats)
+    print(f"Speed-up: {after / before:.2f}x unfiltered, {filtered / before:.2f}x filtered")
@@ -0,0 +1,265 @@
+# End-to-end benchmarks for the decode, session handling, roster lookup and render paths, with results written as JSON
+# so runs can be compared across commits. Runs on plain Linux with no CAN hardware or roster server.
+#
+# Run from the repository root with: poetry run python benchmarks/run_benchmarks.py --output results.json
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+from can import Message
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from decode_benchmark import generate_frames
+from cbus import CbusInterface
+from cbus_messages import CbusOpcode, decode_message
+from image_pipeline import ImagePipeline
+from sessions import SessionTable
+from roster import RosterClient
+from roster_cache import RosterCache
+from roster_index import RosterIndex
+
+N_ROSTER_ENTRIES = 200
+
+
+def time_per_call(function: Callable[[], object], n_calls: int, repeats: int) -> float:
+    """Returns the best time per call, in seconds, over a number of runs."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            function()
+        elapsed = (time.perf_counter() - start) / n_calls
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_frames(handler: Callable[[Message], object], frames: List[Message], repeats: int, setup: Optional[Callable[[], object]] = None) -> float:
+    """Returns the best frames per second for handler over a number of runs, calling setup (untimed) before each."""
+    best = None
+    for _ in range(repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for frame in frames:
+            handler(frame)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(frames) / best
+
+
+def benchmark_decode(n_frames: int, repeats: int) -> dict:
+    rng = random.Random(1)
+    frame_data = {
+        "RLOC": lambda: [CbusOpcode.RLOC, 0xC0 | rng.randrange(64), rng.randrange(256)],
+        "KLOC": lambda: [CbusOpcode.KLOC, rng.randrange(256)],
+        "DKEEP": lambda: [CbusOpcode.DKEEP, rng.randrange(256)],
+        "DSPD": lambda: [CbusOpcode.DSPD, rng.randrange(256), rng.randrange(256)],
+        "DFUN": lambda: [CbusOpcode.DFUN, rng.randrange(256), rng.randrange(1, 6), rng.randrange(256)],
+        "PLOC": lambda: [CbusOpcode.PLOC, rng.randrange(256), 0xC0 | rng.randrange(64), rng.randrange(256), rng.randrange(256), rng.randrange(32), rng.randrange(16), rng.randrange(16)],
+        "unhandled": lambda: [0x90, 0, 1, 0, 2],
+    }
+    results = {}
+    for name, generate_data in frame_data.items():
+        frames = [Message(arbitration_id=1, data=generate_data(), is_extended_id=False) for _ in range(n_frames)]
+        results[name] = {"frames_per_s": time_frames(decode_message, frames, repeats)}
+    return results
+
+
+def benchmark_dispatch(n_frames: int, repeats: int) -> dict:
+    results = {}
+    for n_sessions in (1, 8, 32, 128):
+        # No session churn, so every DSPD and DFUN is for a known session, and the table holds n_sessions throughout.
+        frames = generate_frames(n_frames, n_sessions, seed=n_sessions, session_churn=False)
+        cbus_interface = CbusInterface("benchmark", 0, bustype="virtual")
+
+        def dispatch(frame: Message):
+            cbus_interface.on_message_received(frame)
+
+        def prime():
+            # A fresh table with every session, for each run.
+            session_table = SessionTable()
+            cbus_interface.listener = session_table.process
+            for session_id in range(1, n_sessions + 1):
+                dispatch(Message(arbitration_id=1, data=[CbusOpcode.PLOC, session_id, 0xC0, session_id, 0, 0, 0, 0], is_extended_id=False))
+            return session_table
+
+        frames_per_s = time_frames(dispatch, frames, repeats, setup=prime)
+        # Labelled by the sessions actually active, measured with one more (untimed) run.
+        session_table = prime()
+        for frame in frames:
+            dispatch(frame)
+        results[f"{len(session_table)}_sessions"] = {"frames_per_s": frames_per_s, "active_sessions": len(session_table)}
+    return results
+
+
+class StubRosterHandler(BaseHTTPRequestHandler):
+    """Serves a generated roster, standing in for the roster API."""
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/roster_entries":
+            self.send_body({"roster_entries": [get_stub_roster_entry(address) for address in range(1, N_ROSTER_ENTRIES + 1)]})
+        elif path.startswith("/roster_entry/address/"):
+            self.send_body({"roster_entry": get_stub_roster_entry(int(path.rsplit("/", 1)[1]))})
+        elif path.endswith("/image"):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.server.image_bytes)))
+            self.end_headers()
+            self.wfile.write(self.server.image_bytes)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def send_body(self, body: dict):
+        body_bytes = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body_bytes)))
+        self.end_headers()
+        self.wfile.write(body_bytes)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_stub_roster_entry(address: int) -> dict:
+    return {
+        "roster_id": f"loco{address}",
+        "number": str(37000 + address),
+        "dcc_address": str(address),
+        "name": f"Benchmark locomotive number {address} with a long name",
+        "functions": [{"number": number, "name": f"Function {number}", "lockable": number % 3 != 0} for number in range(29)],
+    }
+
+
+def create_stub_image() -> bytes:
+    image_bytes = BytesIO()
+    Image.new("RGB", (1200, 800), (120, 60, 30)).save(image_bytes, format="jpeg")
+    return image_bytes.getvalue()
+
+
+def benchmark_roster(repeats: int) -> dict:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubRosterHandler)
+    server.image_bytes = create_stub_image()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    cache_directory = tempfile.mkdtemp()
+    addresses = list(range(1, N_ROSTER_ENTRIES + 1))
+    try:
+        results = {}
+
+        def time_lookups(lookup: Callable[[int], object]) -> float:
+            start = time.perf_counter()
+            for address in addresses:
+                lookup(address)
+            return (time.perf_counter() - start) / len(addresses)
+
+        cold_client = RosterClient(base_url)
+        results["cold_s"] = time_lookups(cold_client.get_roster_entry)
+        cold_client.close()
+
+        cached_client = RosterClient(base_url, cache=RosterCache(cache_directory))
+        results["cache_fill_s"] = time_lookups(cached_client.get_roster_entry)
+        results["cached_s"] = min(time_lookups(cached_client.get_roster_entry) for _ in range(repeats))
+        cached_client.close()
+
+        indexed_client = RosterClient(base_url, cache=RosterCache(cache_directory), index=RosterIndex())
+        start = time.perf_counter()
+        indexed_client.refresh_index()
+        results["bulk_prefetch_s"] = time.perf_counter() - start
+        results["indexed_s"] = min(time_lookups(indexed_client.get_cached_roster_entry) for _ in range(repeats))
+        indexed_client.close()
+
+        image_pipeline = ImagePipeline(RosterCache(cache_directory))
+        results["image_prepare_s"] = time_per_call(lambda: image_pipeline.prepare_blocking(f"loco{random.random()}", server.image_bytes), 5, 1)
+        image_pipeline.prepare_blocking("loco1", server.image_bytes)
+        results["image_cached_s"] = time_per_call(lambda: image_pipeline.get_cached("loco1", server.image_bytes), 20, repeats)
+        image_pipeline.close()
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_directory, ignore_errors=True)
+
+
+def benchmark_layout(repeats: int) -> dict:
+    from display import ThrottleDisplay
+    results = {"create_layout_s": time_per_call(lambda: ThrottleDisplay.create_layout(ThrottleDisplay.__new__(ThrottleDisplay)), 5, repeats)}
+    # Building a real window needs an X server; run under Xvfb (e.g. xvfb-run) to include these.
+    if os.environ.get("DISPLAY"):
+        from display import prepare_ui
+        from throttle_helper import ThrottleHelper
+        prepare_ui()
+        start = time.perf_counter()
+        throttle_display = ThrottleDisplay()
+        results["create_window_s"] = time.perf_counter() - start
+        throttle_helper = ThrottleHelper()
+        throttle_helper.set_address(1)
+        throttle_helper.set_roster_entry(get_stub_roster_entry(1))
+        throttle_helper.speed = 0
+        results["show_roster_entry_s"] = time_per_call(lambda: (throttle_display.show_roster_entry(throttle_helper), throttle_display.refresh()), 1, 1)
+
+        def update_speed():
+            throttle_helper.speed = (throttle_helper.speed + 1) % 127
+            throttle_display.update_state(throttle_helper)
+            throttle_display.refresh()
+
+        results["update_state_s"] = time_per_call(update_speed, 50, repeats)
+        throttle_display.close()
+    return results
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--output", help="File to write the JSON results to (default: stdout)")
+    parser.add_argument("--frames", type=int, default=50000, help="Number of frames per decode/dispatch run")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs; the best is reported")
+    parser.add_argument("--only", nargs="*", choices=("decode", "dispatch", "roster", "layout"), help="Only run these benchmarks")
+    args = parser.parse_args()
+
+    benchmarks = {
+        "decode": lambda: benchmark_decode(args.frames, args.repeats),
+        "dispatch": lambda: benchmark_dispatch(args.frames, args.repeats),
+        "roster": lambda: benchmark_roster(args.repeats),
+        "layout": lambda: benchmark_layout(args.repeats),
+    }
+    results = {
+        "commit": get_commit(),
+        "timestamp": time.time(),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": {},
+    }
+    for name, benchmark in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        print(f"Running {name} benchmarks...", file=sys.stderr)
+        results["results"][name] = benchmark()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
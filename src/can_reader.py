@@ -0,0 +1,166 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Optional
+import can
+from can import Message
+from cbus_messages import CbusOpcode
+
+# The most frames that can be waiting for the asyncio loop. At a full 125kbps CBUS that is well over a second of traffic.
+BUFFER_SIZE = 1024
+# How long the reader blocks waiting for a frame before checking whether it has been stopped.
+RECEIVE_TIMEOUT = 0.5
+# How long to wait before reading again after the bus reports an error.
+ERROR_BACKOFF = 1.0
+# The reader thread is made this much less nice than the rest of the process, if the OS allows it (it needs CAP_SYS_NICE).
+READER_NICENESS = -5
+
+# What to do with a frame that arrives when the buffer is full.
+OVERFLOW_DROP_OLDEST = "drop_oldest"    # Make room by dropping the oldest frame.
+OVERFLOW_COALESCE = "coalesce"          # Replace the newest waiting DSPD for the same session, as only the latest speed matters. Otherwise drop the oldest frame.
+
+
+class CanReader:
+    """Reads frames from a bus on a dedicated thread, so a slow GUI operation on the asyncio loop can never hold up reading
+    and overflow the kernel's socket queue.
+
+    Frames (with their kernel timestamps) are held in a bounded buffer, and handed to the loop in batches: the loop is only
+    woken when the buffer goes from empty to not empty, and then takes everything that has arrived since in one go.
+
+    Counters:
+        received: frames read from the bus.
+        filtered: frames dropped by the prefilter, before they were buffered.
+        batches: batches handed to the loop.
+        largest_batch: the most frames handed to the loop at once.
+        coalesced: DSPD frames that replaced an older one for the same session, because the buffer was full.
+        dropped: frames dropped because the buffer was full."""
+
+    bus: can.BusABC
+    handler: Callable[[Message], None]
+    # Called on the reader thread for every frame; frames it returns False for are dropped there and then.
+    prefilter: Optional[Callable[[Message], bool]]
+    loop: asyncio.AbstractEventLoop
+    buffer_size: int
+    overflow_policy: str
+    received: int
+    filtered: int
+    batches: int
+    largest_batch: int
+    coalesced: int
+    dropped: int
+    _buffer: Deque[Message]
+    # Guards the buffer and _drain_scheduled. It is only ever held for a few operations, never while handling frames.
+    _lock: threading.Lock
+    _drain_scheduled: bool
+    _running: bool
+    _thread: Optional[threading.Thread]
+
+    def __init__(self, bus: can.BusABC, handler: Callable[[Message], None], loop: Optional[asyncio.AbstractEventLoop] = None,
+            buffer_size: int = BUFFER_SIZE, overflow_policy: str = OVERFLOW_COALESCE, prefilter: Optional[Callable[[Message], bool]] = None):
+        self.bus = bus
+        self.handler = handler
+        self.prefilter = prefilter
+        self.loop = loop or asyncio.get_event_loop()
+        self.buffer_size = buffer_size
+        self.overflow_policy = overflow_policy
+        self.received = 0
+        self.filtered = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._drain_scheduled = False
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._read, name="can-reader", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(RECEIVE_TIMEOUT * 2)
+
+    def _read(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), READER_NICENESS)
+        except (OSError, AttributeError) as e:
+            logging.debug(f"Could not raise the priority of the CAN reader thread: {str(e)}")
+        while self._running:
+            try:
+                message = self.bus.recv(RECEIVE_TIMEOUT)
+            except can.CanError as e:
+                logging.error(f"Error reading from the bus: {str(e)}")
+                time.sleep(ERROR_BACKOFF)
+                continue
+            if message is None:
+                continue
+            self.received += 1
+            try:
+                if self.prefilter is not None and not self.prefilter(message):
+                    self.filtered += 1
+                    continue
+                self.put(message)
+            except Exception:
+                # One bad frame must not end reception.
+                logging.exception("Error reading CAN message")
+
+    def put(self, message: Message):
+        with self._lock:
+            if len(self._buffer) >= self.buffer_size:
+                if self.overflow_policy == OVERFLOW_COALESCE and self._coalesce(message):
+                    return
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(message)
+            if self._drain_scheduled:
+                return
+            self._drain_scheduled = True
+        self.loop.call_soon_threadsafe(self._drain)
+
+    def _coalesce(self, message: Message) -> bool:
+        """Replaces the newest waiting DSPD for the same session with message, if message is a DSPD. Must be called with the lock held."""
+        if message.dlc < 2 or message.data[0] != CbusOpcode.DSPD:
+            return False
+        session_id = message.data[1]
+        buffer = self._buffer
+        for i in range(len(buffer) - 1, -1, -1):
+            waiting = buffer[i]
+            if waiting.dlc >= 2 and waiting.data[0] == CbusOpcode.DSPD and waiting.data[1] == session_id:
+                buffer[i] = message
+                self.coalesced += 1
+                return True
+        return False
+
+    def _drain(self):
+        with self._lock:
+            batch, self._buffer = self._buffer, deque()
+            self._drain_scheduled = False
+        self.batches += 1
+        if len(batch) > self.largest_batch:
+            self.largest_batch = len(batch)
+        handler = self.handler
+        for message in batch:
+            try:
+                handler(message)
+            except Exception:
+                # One bad frame must not lose the rest of the batch.
+                logging.exception("Error handling CAN message")
+
+    def get_stats(self) -> dict:
+        return {
+            "received": self.received,
+            "filtered": self.filtered,
+            "waiting": len(self._buffer),
+            "batches": self.batches,
+            "largest_batch": self.largest_batch,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
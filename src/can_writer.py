@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Hashable, List, Optional
+import can
+from can import Message
+
+# Send priorities, highest first. Higher priority frames are always sent before lower ones, and also win CAN arbitration.
+PRIORITY_HIGH = 0       # e.g. an emergency stop.
+PRIORITY_NORMAL = 1     # Speed and function changes.
+PRIORITY_LOW = 2        # Keep-alives.
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+# CBUS is 125kbps, which is roughly 1000 frames a second. A display should only ever use a small share of that.
+MAX_FRAMES_PER_SECOND = 50
+# The most frames that can be waiting to be sent. Beyond that, send() refuses new frames, so the caller knows to back off.
+MAX_QUEUED = 32
+# How long to wait before trying again when the socket's transmit queue is full.
+TX_FULL_BACKOFF = 0.05
+
+
+class CanWriter:
+    """Sends frames from a priority-ordered, rate-limited queue on the asyncio loop.
+
+    Each frame is queued under a key (e.g. the opcode and session), and a frame queued while another with the same key is
+    still waiting replaces it in place, so a burst of commands (e.g. speed changes while a knob is spun) only sends the
+    latest. Queuing never blocks: send() returns False when the queue is full, and `backpressure` is set while the
+    socket's transmit queue is full.
+
+    Counters:
+        queued: frames accepted by send().
+        sent: frames sent.
+        coalesced: frames that replaced a waiting frame with the same key.
+        rejected: frames refused because the queue was full.
+        tx_full: times a send found the socket's transmit queue full."""
+
+    bus: can.BusABC
+    frame_interval: float
+    max_queued: int
+    backpressure: bool
+    queued: int
+    sent: int
+    coalesced: int
+    rejected: int
+    tx_full: int
+    # One queue per priority, each key -> frame in the order they were first queued.
+    _queues: List["OrderedDict[Hashable, Message]"]
+    _wakeup: asyncio.Event
+    _task: Optional[asyncio.Task]
+
+    def __init__(self, bus: can.BusABC, max_frames_per_second: float = MAX_FRAMES_PER_SECOND, max_queued: int = MAX_QUEUED):
+        self.bus = bus
+        self.frame_interval = 1 / max_frames_per_second
+        self.max_queued = max_queued
+        self.backpressure = False
+        self.queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.tx_full = 0
+        self._queues = [OrderedDict() for _ in PRIORITIES]
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues)
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def send(self, key: Hashable, message: Message, priority: int = PRIORITY_NORMAL) -> bool:
+        """Queues a frame to be sent, replacing any frame still waiting with the same key. Returns False if the queue is full."""
+        queue = self._queues[priority]
+        if key in queue:
+            queue[key] = message
+            self.coalesced += 1
+            return True
+        if len(self) >= self.max_queued:
+            self.rejected += 1
+            return False
+        # A frame with the same key waiting at a lower priority is now out of date, and must not be sent after this one.
+        for other_queue in self._queues[priority + 1:]:
+            other_queue.pop(key, None)
+        queue[key] = message
+        self.queued += 1
+        self._wakeup.set()
+        return True
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        next_send_time = loop.time()
+        while True:
+            await self._wakeup.wait()
+            while True:
+                queue = next((queue for queue in self._queues if queue), None)
+                if queue is None:
+                    break
+                delay = next_send_time - loop.time()
+                if delay > 0:
+                    # The frame isn't taken off the queue until it is sent, so it can still be replaced while waiting.
+                    await asyncio.sleep(delay)
+                    continue
+                key, message = next(iter(queue.items()))
+                try:
+                    self.bus.send(message)
+                except can.CanOperationError as e:
+                    # Most likely the socket's transmit queue is full (ENOBUFS), so leave the frame where it is and give it time to drain.
+                    if not self.backpressure:
+                        logging.warning(f"CAN transmit queue full, holding back {len(self)} frames: {str(e)}")
+                    self.backpressure = True
+                    self.tx_full += 1
+                    next_send_time = loop.time() + TX_FULL_BACKOFF
+                    continue
+                del queue[key]
+                self.backpressure = False
+                self.sent += 1
+                next_send_time = loop.time() + self.frame_interval
+            self._wakeup.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            "waiting": len(self),
+            "queued": self.queued,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "tx_full": self.tx_full,
+            "backpressure": self.backpressure,
+        }
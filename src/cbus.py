@@ -1,64 +1,172 @@
-import os
 import time
 import can
 import logging
 import asyncio
-from rich.logging import RichHandler
+import subprocess
 from can import Message
-from typing import Callable
-from cbus_messages import CbusMessageEngineReport, CbusMessageReleaseEngine, CbusMessageSetEngineFunctions, CbusMessageSetEngineSpeedDir, CbusOpcode, CbusMessage, CbusMessageRequestEngineSession
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AbstractSet, Callable, Iterable, List, Optional
+from can_reader import CanReader
+from can_writer import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, CanWriter
+from cbus_messages import DECODERS, FUNCTION_RANGE_BY_NUMBER, CbusMessage, CbusMessageSessionKeepAlive, CbusMessageSetEngineFunctions, CbusMessageSetEngineSpeedDir, CbusOpcode, Direction, decode_message, is_frame_short, is_frame_wanted
+from instrumentation import STAGE_DECODE, STAGE_DISPATCH, STAGE_RECEIVE_QUEUE, metrics
+
+# The python-can interfaces that are real CAN hardware, and so need the kernel interface configuring before use.
+# Anything else (e.g. "virtual") is used as-is, which allows the whole stack to run on a development machine.
+HARDWARE_BUSTYPES = ("socketcan",)
+# A longer transmit queue than the default of 10 stops sends failing with "No buffer space available" on a busy bus.
+TX_QUEUE_LENGTH = 1000
+# The CAN IDs a CBUS node can send with (7 bits, 0 is reserved).
+MIN_CAN_ID = 1
+MAX_CAN_ID = 127
+# CBUS major priority for everything we send (0b10 is the lowest that is allowed, i.e. normal traffic), and the minor priority for each send priority.
+MAJOR_PRIORITY = 0b10
+MINOR_PRIORITIES = {PRIORITY_HIGH: 0b00, PRIORITY_NORMAL: 0b10, PRIORITY_LOW: 0b11}
+
 
 class CbusInterface:
 
     interface: str
+    bustype: str
     bus: can.interface.Bus = None
-    notifier: can.Notifier = None
+    reader: CanReader = None
+    writer: CanWriter = None
+    # The CAN ID this node sends with, or None if it only listens. Every node on a CBUS bus needs a different one.
+    can_id: Optional[int] = None
+    can_listeners: List[can.Listener] = []
     listener: Callable[[CbusMessage], None]
+    session_filter: Optional[AbstractSet[int]] = None
+    # When (time.perf_counter()) the most recent frame reached Python, so later stages can measure latency from it (None after an echoed send).
+    last_receive_time: float = None
+    # Completes once the kernel interface has been configured, if it needs to be.
+    configured: Optional[Future] = None
 
-    def __init__(self, interface: str, bitrate: int):
+    def __init__(self, interface: str, bitrate: int, bustype: str = "socketcan", can_id: Optional[int] = None):
+        if can_id is not None and not MIN_CAN_ID <= can_id <= MAX_CAN_ID:
+            raise ValueError(f"CAN ID must be between {MIN_CAN_ID} and {MAX_CAN_ID}, not {can_id}")
         self.interface = interface
+        self.bustype = bustype
+        self.can_id = can_id
+        if self.is_hardware():
+            # Configuring the interface shells out to ip, so do it on a thread, alongside the rest of startup (e.g. creating the window).
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="can-configure")
+            self.configured = executor.submit(self.configure, bitrate)
+            executor.shutdown(wait=False)
+
+    def is_hardware(self) -> bool:
+        # vcan interfaces are socketcan, but are virtual and cannot be configured like a real one.
+        return self.bustype in HARDWARE_BUSTYPES and not self.interface.startswith("vcan")
+
+    def configure(self, bitrate: int):
+        # Each ip command returns once the kernel has made the change, so there is no need to wait before the next one, or before listening.
+        interface = self.interface
         logging.debug(f"Configuring {interface} at {bitrate}bps")
-        os.system(f"sudo ip link set {interface} type can bitrate {bitrate}")
+        self.run_ip("link", "set", interface, "type", "can", "bitrate", str(bitrate))
         logging.debug(f"Enabling {interface}")
-        os.system(f"sudo ifconfig {interface} up")
-        time.sleep(0.1)
-        os.system(f"sudo ifconfig {interface} txqueuelen 1000")
-        time.sleep(0.1)
+        self.run_ip("link", "set", interface, "txqueuelen", str(TX_QUEUE_LENGTH), "up")
+
+    def run_ip(self, *args: str):
+        result = subprocess.run(["sudo", "ip", *args], capture_output=True, text=True)
+        if result.returncode != 0:
+            # e.g. the bitrate can't be changed if the interface was left up by a previous run, which is harmless.
+            logging.warning(f"ip {' '.join(args)} failed: {result.stderr.strip()}")
     
     def close(self):
-        self.notifier.stop()
-        self.bus.shutdown()
-        logging.debug(f"Disabling {self.interface}")
-        os.system(f"sudo ifconfig {self.interface} down")
+        if self.reader:
+            self.reader.stop()
+        if self.writer:
+            self.writer.stop()
+        for can_listener in self.can_listeners:
+            can_listener.stop()
+        if self.bus:
+            self.bus.shutdown()
+        if self.is_hardware():
+            logging.debug(f"Disabling {self.interface}")
+            self.run_ip("link", "set", self.interface, "down")
     
-    async def listen(self, listener: Callable[[CbusMessage], None]):
+    async def listen(self, listener: Callable[[CbusMessage], None], can_listeners: Iterable[can.Listener] = ()):
+        """Starts passing decoded messages to listener. Raw CAN messages are also passed to any can_listeners (e.g. a CbusLogWriter capturing traffic)."""
         self.listener = listener
-        self.bus = can.interface.Bus(channel = self.interface, bustype = "socketcan")
-        logging.debug(f"Listening to {self.interface}")
-        # Create Notifier with an explicit loop to use for scheduling of callbacks
-        self.notifier = can.Notifier(self.bus, listeners = [self.on_message_received], loop = asyncio.get_event_loop())
+        self.can_listeners = list(can_listeners)
+        if self.configured:
+            await asyncio.wrap_future(self.configured)
+        self.bus = can.interface.Bus(channel = self.interface, bustype = self.bustype)
+        logging.debug(f"Listening to {self.interface} ({self.bustype})")
+        # Frames are read on the reader's own thread, and handed to the loop in batches. Unless traffic is being captured,
+        # frames that would only be thrown away are dropped there, before they are buffered or reach the loop.
+        # (socketcan's kernel filters can only match on the CAN ID, which in CBUS identifies the sending node, not the opcode or session.)
+        self.reader = CanReader(self.bus, self.on_raw_message_received if self.can_listeners else self.on_message_received, asyncio.get_event_loop(),
+            prefilter = None if self.can_listeners else self.is_frame_wanted)
+        self.reader.start()
+        if self.can_id is not None:
+            self.writer = CanWriter(self.bus)
+            self.writer.start()
+
+    def send(self, key, data: bytes, priority: int = PRIORITY_NORMAL, echo: bool = True) -> bool:
+        """Queues a CBUS message to be sent (see CanWriter), returning False if it was refused because too much is already waiting.
+        Only possible if the interface was given a CAN ID.
+
+        A CAN socket never receives its own frames, so if echo is set an accepted message is also passed to the listener,
+        exactly as if it had been received."""
+        arbitration_id = (MAJOR_PRIORITY << 9) | (MINOR_PRIORITIES[priority] << 7) | self.can_id
+        message = Message(arbitration_id=arbitration_id, data=data, is_extended_id=False)
+        if not self.writer.send(key, message, priority):
+            return False
+        if echo:
+            # It never came from the bus, so there is no receive time for later stages to measure latency from.
+            self.last_receive_time = None
+            self.listener(decode_message(message))
+        return True
+
+    def send_speed_direction(self, session_id: int, speed: int, direction: Direction) -> bool:
+        # An emergency stop jumps the queue.
+        priority = PRIORITY_HIGH if speed == -1 else PRIORITY_NORMAL
+        return self.send((CbusOpcode.DSPD, session_id), CbusMessageSetEngineSpeedDir.encode(session_id, speed, direction), priority)
+
+    def send_functions(self, session_id: int, functions: int, function_number: int, coalesce: bool = True) -> bool:
+        """Sends the states of the functions in function_number's range, taken from functions (a bitmask, bit n for Fn).
+
+        Unless coalesce is set, a DFUN still waiting to be sent with different states isn't replaced, so that e.g. both the
+        press and the release of a momentary function are sent, however quickly they follow each other."""
+        function_range = FUNCTION_RANGE_BY_NUMBER[function_number]
+        data = CbusMessageSetEngineFunctions.encode(session_id, function_range, functions)
+        return self.send((CbusOpcode.DFUN, session_id, function_range) if coalesce else (CbusOpcode.DFUN, session_id, function_range, data), data)
+
+    def send_keep_alive(self, session_id: int) -> bool:
+        return self.send((CbusOpcode.DKEEP, session_id), CbusMessageSessionKeepAlive.encode(session_id), PRIORITY_LOW, echo=False)
+
+    def on_raw_message_received(self, message: Message):
+        for can_listener in self.can_listeners:
+            can_listener.on_message_received(message)
+        self.on_message_received(message)
+
+    def set_session_filter(self, session_ids: Optional[Iterable[int]]):
+        """Only pass on DSPD and DFUN messages for the given sessions. None passes on messages for all sessions."""
+        # Replacing the whole set is atomic, so the reader thread always sees either the old filter or the new one.
+        self.session_filter = None if session_ids is None else frozenset(session_ids)
+
+    def is_frame_wanted(self, message: Message) -> bool:
+        return is_frame_wanted(message.data, self.session_filter)
 
     def on_message_received(self, message: Message):
-        id = message.arbitration_id
+        receive_time = time.perf_counter()
+        self.last_receive_time = receive_time
         if message.dlc > 0:
             op_code = message.data[0]
-            logging.debug("Message Opcode: %s", op_code)
-            cbus_message: CbusMessage = None
-            if op_code == CbusOpcode.RLOC:
-                cbus_message = CbusMessageRequestEngineSession(message)
-            elif op_code == CbusOpcode.KLOC:
-                cbus_message = CbusMessageReleaseEngine(message)
-            elif op_code == CbusOpcode.DSPD:
-                cbus_message = CbusMessageSetEngineSpeedDir(message)
-            elif op_code == CbusOpcode.DFUN:
-                cbus_message = CbusMessageSetEngineFunctions(message)
-            elif op_code == CbusOpcode.PLOC:
-                cbus_message = CbusMessageEngineReport(message)
-
+            metrics.frame_counts[op_code] += 1
+            if message.timestamp:
+                metrics.record(STAGE_RECEIVE_QUEUE, time.time() - message.timestamp)
+            cbus_message = decode_message(message, self.session_filter)
+            decode_time = time.perf_counter()
+            metrics.record(STAGE_DECODE, decode_time - receive_time)
             if cbus_message is not None:
                 self.listener(cbus_message)
-            else:
-                # logging.warning("CBUS message was not created")
-                pass
+                metrics.record(STAGE_DISPATCH, time.perf_counter() - decode_time)
+            elif op_code in DECODERS:
+                if is_frame_short(message.data):
+                    metrics.short_frames += 1
+                else:
+                    # A message we understand, but that was filtered out before decoding.
+                    metrics.dropped_frames += 1
         else:
             logging.warning("CAN Message has no payload")
@@ -0,0 +1,158 @@
+# Capture and replay of CBUS traffic, so that busy-layout conditions can be reproduced (and measured) without hardware.
+#
+# Record live traffic:      python src/cbus_log.py record traffic.cbuslog --channel can0
+# Replay into the decoder:  python src/cbus_log.py replay traffic.cbuslog --speed 0
+# Replay onto a bus:        python src/cbus_log.py replay traffic.cbuslog --target bus --channel vcan0 --speed 1
+import time
+import struct
+import logging
+import argparse
+from typing import BinaryIO, Callable, Iterable, Iterator, List
+import can
+from can import Message
+from cbus import CbusInterface
+from sessions import SessionTable
+
+# Logs start with this, followed by one record per frame: a RECORD header, then the frame's data bytes.
+MAGIC = b"CBUSLOG1"
+# Timestamp (seconds), arbitration ID, flags, DLC.
+RECORD = struct.Struct("<dIBB")
+FLAG_EXTENDED_ID = 0x01
+FLAG_REMOTE_FRAME = 0x02
+
+
+class CbusLogWriter(can.Listener):
+    """Writes every CAN message it receives to a compact binary log. Pass it to CbusInterface.listen as a can_listener, and it is
+    given every frame (before any filtering) on the asyncio loop, as the CanReader hands them over."""
+
+    file: BinaryIO
+    n_messages: int
+
+    def __init__(self, path: str):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.n_messages = 0
+
+    def on_message_received(self, message: Message):
+        flags = (FLAG_EXTENDED_ID if message.is_extended_id else 0) | (FLAG_REMOTE_FRAME if message.is_remote_frame else 0)
+        data = bytes(message.data or b"")
+        self.file.write(RECORD.pack(message.timestamp, message.arbitration_id, flags, len(data)) + data)
+        self.n_messages += 1
+
+    def stop(self):
+        self.file.close()
+
+
+def read_log(path: str) -> Iterator[Message]:
+    with open(path, "rb") as log_file:
+        if log_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a CBUS log")
+        while True:
+            header = log_file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, arbitration_id, flags, dlc = RECORD.unpack(header)
+            yield Message(timestamp=timestamp, arbitration_id=arbitration_id, is_extended_id=bool(flags & FLAG_EXTENDED_ID),
+                is_remote_frame=bool(flags & FLAG_REMOTE_FRAME), data=log_file.read(dlc))
+
+
+def replay(messages: Iterable[Message], handler: Callable[[Message], None], speed: float = 1.0) -> int:
+    """Passes messages to handler, keeping the gaps between them as recorded, divided by speed. A speed of 0 replays as fast as possible. Returns the number of messages replayed."""
+    n_messages = 0
+    first_timestamp = None
+    start = time.monotonic()
+    for message in messages:
+        if speed > 0:
+            if first_timestamp is None:
+                first_timestamp = message.timestamp
+            delay = start + (message.timestamp - first_timestamp) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        handler(message)
+        n_messages += 1
+    return n_messages
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+
+def replay_into_pipeline(messages: Iterable[Message], speed: float) -> dict:
+    """Replays messages through the decoder and session table, as main.py would, measuring throughput and per-frame processing time."""
+    session_table = SessionTable()
+    cbus_interface = CbusInterface("replay", 0, bustype="virtual")
+    cbus_interface.listener = session_table.process
+    processing_times = []
+
+    def handle(message: Message):
+        start = time.perf_counter()
+        cbus_interface.on_message_received(message)
+        processing_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    n_messages = replay(messages, handle, speed)
+    elapsed = time.perf_counter() - start
+    processing_times.sort()
+    return {
+        "frames": n_messages,
+        "elapsed_s": elapsed,
+        "frames_per_s": n_messages / elapsed if elapsed else 0.0,
+        "processing_p50_us": get_percentile(processing_times, 50) * 1e6,
+        "processing_p99_us": get_percentile(processing_times, 99) * 1e6,
+        "processing_max_us": (processing_times[-1] if processing_times else 0.0) * 1e6,
+        "active_sessions": len(session_table),
+    }
+
+
+def record(path: str, channel: str, bustype: str, duration: float):
+    bus = can.interface.Bus(channel = channel, bustype = bustype)
+    writer = CbusLogWriter(path)
+    notifier = can.Notifier(bus, [writer])
+    logging.info(f"Recording {channel} to {path}, press Ctrl+C to stop")
+    try:
+        if duration:
+            time.sleep(duration)
+        else:
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        notifier.stop()
+        writer.stop()
+        bus.shutdown()
+    logging.info(f"Recorded {writer.n_messages} messages")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(message)s")
+    parser = argparse.ArgumentParser(description="Capture and replay CBUS traffic.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="Capture live traffic to a log")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--channel", default="can0")
+    record_parser.add_argument("--bustype", default="socketcan")
+    record_parser.add_argument("--duration", type=float, default=0, help="Seconds to record for (default: until Ctrl+C)")
+    replay_parser = subparsers.add_parser("replay", help="Replay a log")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier, or 0 for as fast as possible")
+    replay_parser.add_argument("--target", choices=("pipeline", "bus"), default="pipeline", help="Feed the decoder and session table directly, or send onto a bus")
+    replay_parser.add_argument("--channel", default="vcan0")
+    replay_parser.add_argument("--bustype", default="socketcan")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.path, args.channel, args.bustype, args.duration)
+    elif args.target == "pipeline":
+        results = replay_into_pipeline(read_log(args.path), args.speed)
+        for name, value in results.items():
+            print(f"{name:<20} {value:,.2f}" if isinstance(value, float) else f"{name:<20} {value}")
+    else:
+        bus = can.interface.Bus(channel = args.channel, bustype = args.bustype)
+        try:
+            n_messages = replay(read_log(args.path), bus.send, args.speed)
+        finally:
+            bus.shutdown()
+        logging.info(f"Replayed {n_messages} messages onto {args.channel}")
@@ -1,11 +1,10 @@
 from enum import IntEnum
-import logging
-from tkinter import OFF
-from typing import List
+from typing import AbstractSet, Dict, FrozenSet, Optional, Tuple, Type
 from can import Message
 
 class CbusOpcode(IntEnum):
     KLOC = 33
+    DKEEP = 35
     RLOC = 64
     DSPD = 71
     DFUN = 96
@@ -22,16 +21,6 @@ class FunctionState(IntEnum):
     ON = 1
 
 
-class Function:
-
-    number: int = 0
-    state: FunctionState = OFF
-
-    def __init__(self, number: int, state: FunctionState):
-        self.number = number
-        self.state = state
-
-
 def set_bit(value, bit):
     return value | (1<<bit)
 
@@ -41,9 +30,7 @@ def clear_bit(value, bit):
 
 
 def get_decoder_address(upper_byte: int, lower_byte: int) -> int:
-    # logging.debug("Upper byte: %d", upper_byte)
-    # logging.debug("Lower byte: %d", lower_byte)
-    return clear_bit(clear_bit(upper_byte, 7), 6) * 256 + lower_byte
+    return (upper_byte & 0x3F) * 256 + lower_byte
 
 
 def get_direction(byte: int) -> Direction:
@@ -63,35 +50,79 @@ def get_speed(byte: int) -> int:
     return map_nmra_speed_to_friendly_speed(byte & 0x7F)
 
 
-def get_bit_position_for_function_number(function_number: int) -> int:
-    if function_number == 0:            # Special case - F0 is bit 4 for some reason...
-        return 4
-    elif function_number <= 4:          # F1 to F4.
-        return function_number - 1
-    elif function_number <= 8:          # F5 to F8.
-        return function_number - 5
-    elif function_number <= 12:         # F9 to F12
-        return function_number - 9
-    elif function_number <= 20:         # F13 to F20
-        return function_number - 13
-    elif function_number <= 28:         # F21 to F28
-        return function_number - 21
+def map_friendly_speed_to_nmra_speed(speed: int) -> int:
+    if speed == 0:
+        return 0
+    elif speed == -1:
+        return 1
+    else:
+        return speed + 1
+
+
+def get_speed_byte(speed: int, direction: Direction) -> int:
+    return (direction << 7) | map_friendly_speed_to_nmra_speed(speed)
+
+
+# The bit of a DFUN/PLOC function byte that holds each function number's state. F0 is bit 4 of the first range, for some reason...
+FUNCTION_BIT_POSITIONS: Tuple[int, ...] = (4, 0, 1, 2, 3) + (0, 1, 2, 3) * 2 + tuple(range(8)) * 2
 
 
 def get_function_state(byte: int, function_number: int) -> FunctionState:
-    bit_position = get_bit_position_for_function_number(function_number)
-    return (byte >> bit_position) & 0x01
+    return (byte >> FUNCTION_BIT_POSITIONS[function_number]) & 0x01
+
 
+# Speed and direction share a single byte, so both are looked up from 256-entry tables rather than recomputed per frame.
+SPEED_TABLE: Tuple[int, ...] = tuple(get_speed(byte) for byte in range(256))
+DIRECTION_TABLE: Tuple[Direction, ...] = tuple(Direction(get_direction(byte)) for byte in range(256))
 
-def parse_functions(byte: int, first_function_number: int, n_functions: int) -> List[Function]:
-    functions = []
-    for i in range(first_function_number, first_function_number + n_functions):
-        functions.append(Function(i, get_function_state(byte, i)))
+# The (first function number, number of functions) carried by each DFUN function range.
+FUNCTION_RANGES = {
+    1: (0, 5),
+    2: (5, 4),
+    3: (9, 4),
+    4: (13, 8),
+    5: (21, 8),
+}
+
+
+def get_functions(byte: int, first_function_number: int, n_functions: int) -> int:
+    """Returns the states of the functions in a function byte as a bitmask, with bit n holding the state of Fn."""
+    functions = 0
+    for function_number in range(first_function_number, first_function_number + n_functions):
+        functions |= get_function_state(byte, function_number) << function_number
     return functions
 
 
+# For each DFUN function range, the functions it covers as a bitmask (bit n is Fn)...
+FUNCTION_RANGE_MASKS: Dict[int, int] = {
+    function_range: ((1 << n_functions) - 1) << first_function_number
+    for function_range, (first_function_number, n_functions) in FUNCTION_RANGES.items()
+}
+# ...and a 256-entry table mapping the function byte to the states of those functions, as a bitmask.
+FUNCTION_TABLES: Dict[int, Tuple[int, ...]] = {
+    function_range: tuple(get_functions(byte, first_function_number, n_functions) for byte in range(256))
+    for function_range, (first_function_number, n_functions) in FUNCTION_RANGES.items()
+}
+# The functions (F0 to F12) whose states are reported in a PLOC.
+PLOC_FUNCTION_MASK = FUNCTION_RANGE_MASKS[1] | FUNCTION_RANGE_MASKS[2] | FUNCTION_RANGE_MASKS[3]
+# The DFUN function range that each function number is sent in.
+FUNCTION_RANGE_BY_NUMBER: Tuple[int, ...] = tuple(
+    function_range for function_range, (first_function_number, n_functions) in FUNCTION_RANGES.items() for _ in range(n_functions))
+
+
+def get_function_byte(functions: int, function_range: int) -> int:
+    """The inverse of FUNCTION_TABLES: returns the function byte for a range, given the function states as a bitmask (bit n is Fn)."""
+    first_function_number, n_functions = FUNCTION_RANGES[function_range]
+    byte = 0
+    for function_number in range(first_function_number, first_function_number + n_functions):
+        byte |= ((functions >> function_number) & 0x01) << FUNCTION_BIT_POSITIONS[function_number]
+    return byte
+
+
 class CbusMessage:
 
+    __slots__ = ("id", "op_code")
+
     id: int
     op_code: int
 
@@ -102,15 +133,21 @@ class CbusMessage:
 
 class CbusMessageRequestEngineSession(CbusMessage):
 
+    __slots__ = ("address",)
+
     address: int
 
     def __init__(self, can_message: Message):
-        super().__init__(can_message)
-        self.address = get_decoder_address(can_message.data[1], can_message.data[2])
+        data = can_message.data
+        self.id = can_message.arbitration_id
+        self.op_code = data[0]
+        self.address = (data[1] & 0x3F) * 256 + data[2]
 
 
 class CbusSessionMessage(CbusMessage):
 
+    __slots__ = ("session_id",)
+
     session_id: int
 
     def __init__(self, can_message: Message):
@@ -120,55 +157,142 @@ class CbusSessionMessage(CbusMessage):
 
 class CbusMessageReleaseEngine(CbusSessionMessage):
 
+    __slots__ = ()
+
     def __init__(self, can_message: Message):
-        super().__init__(can_message)
+        data = can_message.data
+        self.id = can_message.arbitration_id
+        self.op_code = data[0]
+        self.session_id = data[1]
+
+
+class CbusMessageSessionKeepAlive(CbusSessionMessage):
+
+    __slots__ = ()
+
+    @staticmethod
+    def encode(session_id: int) -> bytes:
+        return bytes((CbusOpcode.DKEEP, session_id))
+
+    def __init__(self, can_message: Message):
+        data = can_message.data
+        self.id = can_message.arbitration_id
+        self.op_code = data[0]
+        self.session_id = data[1]
 
 
 class CbusMessageSetEngineSpeedDir(CbusSessionMessage):
 
+    __slots__ = ("direction", "speed")
+
     direction: Direction
     speed: int
 
+    @staticmethod
+    def encode(session_id: int, speed: int, direction: Direction) -> bytes:
+        return bytes((CbusOpcode.DSPD, session_id, get_speed_byte(speed, direction)))
+
     def __init__(self, can_message: Message):
-        super().__init__(can_message)
-        self.direction = get_direction(can_message.data[2])
-        self.speed = get_speed(can_message.data[2])
+        data = can_message.data
+        self.id = can_message.arbitration_id
+        self.op_code = data[0]
+        self.session_id = data[1]
+        self.direction = DIRECTION_TABLE[data[2]]
+        self.speed = SPEED_TABLE[data[2]]
 
 
 class CbusMessageEngineReport(CbusSessionMessage):
 
+    __slots__ = ("address", "direction", "speed", "functions")
+
     address: int
     direction: Direction
     speed: int
-    functions: List[Function]
+    # The states of the functions in function_mask (bit n is Fn).
+    functions: int
+    function_mask = PLOC_FUNCTION_MASK
 
     def __init__(self, can_message: Message):
-        super().__init__(can_message)
-        self.address = get_decoder_address(can_message.data[2], can_message.data[3])
-        self.direction = get_direction(can_message.data[4])
-        self.speed = get_speed(can_message.data[4])
-        self.functions = []
-        self.functions.extend(parse_functions(can_message.data[5], 0, 5))
-        self.functions.extend(parse_functions(can_message.data[6], 5, 4))
-        self.functions.extend(parse_functions(can_message.data[7], 9, 4))
+        data = can_message.data
+        self.id = can_message.arbitration_id
+        self.op_code = data[0]
+        self.session_id = data[1]
+        self.address = (data[2] & 0x3F) * 256 + data[3]
+        self.direction = DIRECTION_TABLE[data[4]]
+        self.speed = SPEED_TABLE[data[4]]
+        self.functions = FUNCTION_TABLES[1][data[5]] | FUNCTION_TABLES[2][data[6]] | FUNCTION_TABLES[3][data[7]]
 
 
 class CbusMessageSetEngineFunctions(CbusSessionMessage):
 
-    functions: List[Function]
+    __slots__ = ("functions", "function_mask")
+
+    # The states of the functions in function_mask (bit n is Fn).
+    functions: int
+    # The functions in the message's function range. An unknown range covers none.
+    function_mask: int
+
+    @staticmethod
+    def encode(session_id: int, function_range: int, functions: int) -> bytes:
+        """Encodes the states of the functions in function_range, taken from functions (a bitmask, bit n for Fn)."""
+        return bytes((CbusOpcode.DFUN, session_id, function_range, get_function_byte(functions, function_range)))
 
     def __init__(self, can_message: Message):
-        super().__init__(can_message)
-        function_range = can_message.data[2]
-        function_byte = can_message.data[3]
-        logging.debug("Function range: %d", function_range)
-        if function_range == 1:
-            self.functions = parse_functions(function_byte, 0, 5)
-        if function_range == 2:
-            self.functions = parse_functions(function_byte, 5, 4)
-        if function_range == 3:
-            self.functions = parse_functions(function_byte, 9, 4)
-        if function_range == 4:
-            self.functions = parse_functions(function_byte, 13, 8)
-        if function_range == 5:
-            self.functions = parse_functions(function_byte, 21, 8)
\ No newline at end of file
+        data = can_message.data
+        self.id = can_message.arbitration_id
+        self.op_code = data[0]
+        self.session_id = data[1]
+        function_table = FUNCTION_TABLES.get(data[2])
+        self.functions = function_table[data[3]] if function_table else 0
+        self.function_mask = FUNCTION_RANGE_MASKS.get(data[2], 0)
+
+
+# Maps each opcode we understand to the class that decodes it.
+DECODERS: Dict[int, Type[CbusMessage]] = {
+    CbusOpcode.RLOC: CbusMessageRequestEngineSession,
+    CbusOpcode.KLOC: CbusMessageReleaseEngine,
+    CbusOpcode.DKEEP: CbusMessageSessionKeepAlive,
+    CbusOpcode.DSPD: CbusMessageSetEngineSpeedDir,
+    CbusOpcode.DFUN: CbusMessageSetEngineFunctions,
+    CbusOpcode.PLOC: CbusMessageEngineReport,
+}
+
+# The data length (opcode included) of each opcode we understand. CBUS encodes the number of data bytes following the
+# opcode in its top three bits. Shorter frames can't be decoded, and are thrown away.
+MESSAGE_LENGTHS: Dict[int, int] = {op_code: (op_code >> 5) + 1 for op_code in DECODERS}
+
+# Opcodes for messages that only concern an existing session (the session ID is in data[1]), and so can be filtered by session before decoding.
+# Only the busy ones are included: KLOC and DKEEP are rare, and let the session table keep track of every session even while
+# one is being displayed. PLOC is deliberately not included, as it is how a new session is discovered.
+SESSION_FILTERABLE_OPCODES: FrozenSet[int] = frozenset((CbusOpcode.DSPD, CbusOpcode.DFUN))
+
+
+def decode_message(can_message: Message, session_filter: Optional[AbstractSet[int]] = None) -> Optional[CbusMessage]:
+    """Decodes a CAN message into a CbusMessage, or returns None if the opcode is not handled, the message is too short for
+    its opcode (see is_frame_short), or it is for a session not in session_filter."""
+    data = can_message.data
+    if not data:
+        return None
+    decoder = DECODERS.get(data[0])
+    if decoder is None or len(data) < MESSAGE_LENGTHS[data[0]]:
+        return None
+    if session_filter is not None and data[0] in SESSION_FILTERABLE_OPCODES and data[1] not in session_filter:
+        return None
+    return decoder(can_message)
+
+
+def is_frame_short(data: bytearray) -> bool:
+    """Returns whether a frame with an opcode we understand is too short to be decoded."""
+    return len(data) < MESSAGE_LENGTHS[data[0]]
+
+
+def is_frame_wanted(data: bytearray, session_filter: Optional[AbstractSet[int]] = None) -> bool:
+    """A cheap check of a frame's first data bytes, so that frames decode_message would throw away can be dropped before they are buffered or decoded."""
+    if not data:
+        # Let these through, so they are reported.
+        return True
+    op_code = data[0]
+    if op_code not in DECODERS:
+        return False
+    # Frames too short to hold a session ID are let through too, so that they are counted (see is_frame_short).
+    return session_filter is None or op_code not in SESSION_FILTERABLE_OPCODES or len(data) < 2 or data[1] in session_filter
@@ -0,0 +1,342 @@
+import os
+import time
+import logging
+import textwrap
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+import PySimpleGUI as sg
+from cbus_messages import Direction
+from image_pipeline import PreparedImage
+from roster_index import MAX_FUNCTIONS
+from speed_history import SpeedHistory
+from throttle_helper import ThrottleHelper
+
+WINDOW_SIZE = (1024, 600)
+LHS_WIDTH = 502
+
+FONT_H1 = "_ 30"
+FONT_H2 = "_ 24"
+FONT_H3 = "_ 18"
+FONT_H4 = "_ 16"
+FONT_BODY  = "_ 12"
+FONT_LABEL = "_ 10 bold"
+FONT_VALUE = "_ 14"
+
+COLOUR_TEXT = "#FFFFFF"
+COLOUR_FUNCTION_ON = "#FFC107"
+
+KEY_HOME = "-HOME-"
+KEY_LOCO = "-LOCO-"
+KEY_NUMBER = "-NUMBER-"
+KEY_ADDRESS = "-ADDRESS-"
+KEY_SPEED = "-SPEED-"
+KEY_DIRECTION = "-DIRECTION-"
+KEY_NAME = "-NAME-"
+KEY_IMAGE = "-IMAGE-"
+KEY_SPARKLINE = "-SPARKLINE-"
+
+NAME_WRAP_WIDTH = 25
+# Shown in place of the name on the provisional screen, while the roster entry is fetched and if it can't be.
+ROSTER_ENTRY_LOADING = "Loading roster entry..."
+ROSTER_ENTRY_MISSING = "Not in roster"
+# How many locos' roster entry templates are kept, most recently shown first.
+MAX_TEMPLATES = 32
+
+SPARKLINE_SIZE = (LHS_WIDTH, 40)
+# How far back the sparkline goes, across its whole width.
+SPARKLINE_WINDOW = 120.0
+# The display should be refreshed at least this often while a loco is shown, so the sparkline keeps scrolling when the speed isn't changing.
+SPARKLINE_INTERVAL = 1.0
+MAX_SPEED = 126
+
+# Stands in for the value of an element that has not been updated yet (None is a valid value).
+NOT_RENDERED = object()
+
+
+def get_function_label_key(function_number: int) -> str:
+    return f"-F{function_number}-LABEL-"
+
+
+def get_function_name_key(function_number: int) -> str:
+    return f"-F{function_number}-NAME-"
+
+
+FUNCTION_LABEL_KEYS = tuple(get_function_label_key(function_number) for function_number in range(MAX_FUNCTIONS + 1))
+FUNCTION_NAME_KEYS = tuple(get_function_name_key(function_number) for function_number in range(MAX_FUNCTIONS + 1))
+# Pressing and releasing either part of a function tile raise events with that part's key and one of these suffixes, so
+# that momentary functions can be on only while they are held.
+EVENT_PRESS = "+PRESS"
+EVENT_RELEASE = "+RELEASE"
+# Event -> (function number, whether it was a press).
+FUNCTION_TOUCH_EVENTS = {key(function_number) + suffix: (function_number, suffix == EVENT_PRESS)
+    for function_number in range(MAX_FUNCTIONS + 1) for key in (get_function_label_key, get_function_name_key) for suffix in (EVENT_PRESS, EVENT_RELEASE)}
+ALL_FUNCTIONS_MASK = (1 << (MAX_FUNCTIONS + 1)) - 1
+
+
+def prepare_ui():
+    if os.environ.get('DISPLAY','') == '':
+        logging.warning('no display found. Using :0.0')
+        os.environ.__setitem__('DISPLAY', ':0.0')
+
+    # Set the theme
+    sg.theme('Black')
+
+
+class RosterEntryTemplate:
+    """Everything shown for a roster entry that only depends on the entry itself, worked out once so that showing the
+    same loco again only has to bind the values."""
+
+    __slots__ = ("roster_entry", "number", "address", "name", "function_labels", "function_names", "image")
+
+    # The entry the template was made from, to tell when it has changed.
+    roster_entry: dict
+    number: str
+    address: str
+    name: str
+    function_labels: Tuple[str, ...]
+    function_names: Tuple[str, ...]
+    image: Optional[PreparedImage]
+
+    def __init__(self, throttle_helper: ThrottleHelper, image: Optional[PreparedImage]):
+        roster_entry = throttle_helper.roster_entry
+        self.roster_entry = roster_entry
+        self.number = roster_entry["number"]
+        self.address = roster_entry["dcc_address"]
+        # Use textwrap to ensure the name fits, breaking into multiple lines if necessary
+        self.name = "\n".join(textwrap.wrap(roster_entry["name"], NAME_WRAP_WIDTH)) if roster_entry["name"] else ""
+        function_labels = []
+        function_names = []
+        for function_number in range(MAX_FUNCTIONS + 1):
+            function = throttle_helper.get_function(function_number)
+            function_labels.append(f"F{function_number} (mom)" if function and not function["lockable"] else f"F{function_number}")
+            function_names.append(f"{function['name']}" if function else "")
+        self.function_labels = tuple(function_labels)
+        self.function_names = tuple(function_names)
+        self.image = image
+
+    def is_valid_for(self, roster_entry: dict) -> bool:
+        # The roster client hands back the same dict until the entry is fetched again, so comparing is rarely needed.
+        return roster_entry is self.roster_entry or roster_entry == self.roster_entry
+
+
+class Sparkline:
+    """A live trace of a session's recent speed, scrolling from right to left.
+
+    Each update scrolls what has already been drawn and only draws the newest slice on the right, rather than redrawing
+    the whole trace. Only whole pixel columns are drawn, so the trace lags the present by at most one column."""
+
+    graph: sg.Graph
+    seconds_per_column: float
+    history: Optional[SpeedHistory]
+    # The (absolute, i.e. time / seconds_per_column) column drawn up to, and the speed drawn there.
+    _drawn_column: Optional[int]
+    _last_speed: Optional[int]
+    # (figure ID, column its right-hand end was drawn at), oldest first.
+    _figures: Deque[Tuple[int, int]]
+
+    def __init__(self, graph: sg.Graph):
+        self.graph = graph
+        self.seconds_per_column = SPARKLINE_WINDOW / SPARKLINE_SIZE[0]
+        self.history = None
+        self._drawn_column = None
+        self._last_speed = None
+        self._figures = deque()
+
+    def update(self, history: Optional[SpeedHistory], now: float):
+        if history is not self.history:
+            # A different session: start again.
+            self.graph.erase()
+            self._figures.clear()
+            self.history = history
+            self._drawn_column = None
+            self._last_speed = None
+        if history is None:
+            return
+        width = SPARKLINE_SIZE[0]
+        column = int(now / self.seconds_per_column)
+        first_column = column - width if self._drawn_column is None else max(self._drawn_column, column - width)
+        n_columns = column - first_column
+        if n_columns <= 0:
+            return
+        self.graph.move(-n_columns, 0)
+        # Each column shows the highest speed held during it. Emergency stop (-1) is shown as stopped.
+        speeds = history.downsample(first_column * self.seconds_per_column, column * self.seconds_per_column, n_columns)
+        points = [] if self._last_speed is None else [(width - n_columns - 1, self._last_speed)]
+        for i, speed in enumerate(speeds):
+            if speed is not None:
+                points.append((width - n_columns + i, max(speed, 0)))
+        if len(points) > 1:
+            self._figures.append((self.graph.draw_lines(points, color=COLOUR_FUNCTION_ON, width=2), column))
+        if points:
+            self._last_speed = points[-1][1]
+        self._drawn_column = column
+        # Forget whatever has scrolled off the left-hand side.
+        while self._figures and self._figures[0][1] <= column - width:
+            self.graph.delete_figure(self._figures.popleft()[0])
+
+
+class ThrottleDisplay:
+    """The one long-lived window used for everything shown on the display.
+
+    Every element that can change has a key, and the last value written to each is remembered so that an update only
+    touches (and so only redraws) the elements whose value has actually changed."""
+
+    window: sg.Window
+    # (element key, update() argument) -> the last value written, used to skip redundant updates.
+    _rendered: Dict[Tuple[str, str], object]
+    # The function states the function labels were last coloured for (bit n is Fn), or None before they have been.
+    _rendered_functions: Optional[int]
+    sparkline: Sparkline
+    # Roster ID -> template, least recently shown first.
+    _templates: "OrderedDict[str, RosterEntryTemplate]"
+
+    def __init__(self):
+        self._rendered = {}
+        self._rendered_functions = None
+        self._templates = OrderedDict()
+        # The window starts out transparent, so the loco screen can be laid out once before anything is shown.
+        self.window = sg.Window(title="CBUS Throttle Display", layout=self.create_layout(), no_titlebar=True, location=(0,0), size=WINDOW_SIZE, margins=(0,0), keep_on_top=True, alpha_channel=0, finalize=True)
+        # Hide the mouse cursor. # TODO: Not working
+        self.window.set_cursor("none")
+        self.sparkline = Sparkline(self.window[KEY_SPARKLINE])
+        for function_number in range(MAX_FUNCTIONS + 1):
+            for key in (get_function_label_key(function_number), get_function_name_key(function_number)):
+                self.window[key].bind("<ButtonPress-1>", EVENT_PRESS)
+                self.window[key].bind("<ButtonRelease-1>", EVENT_RELEASE)
+        self.prewarm()
+
+    def prewarm(self):
+        """Lays out the (empty) loco screen and then shows the home screen, so the first loco selected only has values to fill in."""
+        self.show_loco()
+        self.refresh()
+        self.show_home()
+        self.refresh()
+        self.window.set_alpha(1)
+
+    def create_layout(self) -> list:
+        home = [ [sg.VPush()],
+            [ sg.Push(), sg.Text("No locomotive selected", font=FONT_H2), sg.Push() ],
+            [sg.VPush()] ]
+
+        info_number = sg.Frame(title=None, layout=[[sg.Text("Number", font=FONT_LABEL)], [sg.Text("", key=KEY_NUMBER, size=(8,1), font=FONT_H2)]], pad=0, border_width=0)
+        info_address = sg.Frame(title=None, layout=[[sg.Text("Address", font=FONT_LABEL)], [sg.Text("", key=KEY_ADDRESS, size=(5,1), font=FONT_H2)]], pad=0, border_width=0)
+        info_speed = sg.Frame(title=None, layout=[[sg.Text("Speed", font=FONT_LABEL)], [sg.Text("", key=KEY_SPEED, size=(4,1), font=FONT_H2)]], pad=0, border_width=0)
+        info_direction = sg.Frame(title=None, layout=[[sg.Text("Direction", font=FONT_LABEL)], [sg.Text("", key=KEY_DIRECTION, size=(7,1), font=FONT_H2)]], pad=0, border_width=0)
+        info_items = [ [info_number, info_address, info_speed, info_direction],
+            [sg.Text("", key=KEY_NAME, font=FONT_H2)] ]
+        info_section = sg.Frame(title=None, layout=info_items, pad=0, border_width=0, expand_x=True)
+        sparkline = sg.Graph(canvas_size=SPARKLINE_SIZE, graph_bottom_left=(0, 0), graph_top_right=(SPARKLINE_SIZE[0], MAX_SPEED), key=KEY_SPARKLINE, pad=0)
+        lhs = sg.Column([ [info_section], [sparkline], [sg.VPush()], [sg.Image(key=KEY_IMAGE, pad=0)] ], pad=0, size=(LHS_WIDTH, WINDOW_SIZE[1]))
+
+        functions = [[self.create_function_grid_item(row + (column * 10), (row + column) % 2 == 0) if row + (column * 10) <= MAX_FUNCTIONS else sg.VPush() for column in range(3)] for row in range(10)]
+        functions_section = sg.Column(functions, expand_y=True, pad=0)
+
+        return [ [ sg.Column(home, key=KEY_HOME, size=WINDOW_SIZE, pad=0),
+            sg.Column([ [lhs, functions_section] ], key=KEY_LOCO, pad=0, visible=False) ] ]
+
+    def create_function_grid_item(self, function_number: int, alternate_bg_colour: bool):
+        background_colour = "#151515" if alternate_bg_colour else "#1F1F1F"
+        function_label = sg.Text(f"F{function_number}", key=get_function_label_key(function_number), expand_x=True, size=(18,1), pad=2, background_color=background_colour, font=FONT_LABEL)
+        function_name = sg.Text("", key=get_function_name_key(function_number), expand_x=True, pad=2, background_color=background_colour, font=FONT_VALUE)
+        layout = [ [function_label], [function_name]]
+        return sg.Frame(title=None, layout=layout, pad=2, expand_y=True, background_color=background_colour, border_width=0)
+
+    def update(self, key: str, **values):
+        changed_values = {name: value for name, value in values.items() if self._rendered.get((key, name), NOT_RENDERED) != value}
+        if changed_values:
+            for name, value in changed_values.items():
+                self._rendered[(key, name)] = value
+            self.window[key].update(**changed_values)
+
+    def show_home(self):
+        self.update(KEY_LOCO, visible=False)
+        self.update(KEY_HOME, visible=True)
+
+    def show_provisional(self, throttle_helper: ThrottleHelper):
+        """Shows a loco whose roster entry has not arrived yet, using what is known from the PLOC."""
+        self.update(KEY_NUMBER, value="")
+        self.update(KEY_ADDRESS, value=throttle_helper.address)
+        self.update(KEY_NAME, value=ROSTER_ENTRY_LOADING)
+        self.show_image(None)
+        for function_number in range(MAX_FUNCTIONS + 1):
+            self.update(get_function_label_key(function_number), value=f"F{function_number}")
+            self.update(get_function_name_key(function_number), value="")
+        self.update_state(throttle_helper)
+        self.show_loco()
+
+    def show_no_roster_entry(self):
+        """Replaces the loading message on the provisional screen once it is known that no roster entry is coming."""
+        self.update(KEY_NAME, value=ROSTER_ENTRY_MISSING)
+
+    def show_roster_entry(self, throttle_helper: ThrottleHelper, image: Optional[PreparedImage] = None):
+        """Shows a loco's roster entry. This binds everything that only changes when a different loco is selected."""
+        template = self.get_template(throttle_helper, image)
+        self.update(KEY_NUMBER, value=template.number)
+        self.update(KEY_ADDRESS, value=template.address)
+        self.update(KEY_NAME, value=template.name)
+        self.show_image(template.image)
+        for key, function_label_text in zip(FUNCTION_LABEL_KEYS, template.function_labels):
+            self.update(key, value=function_label_text)
+        for key, function_name in zip(FUNCTION_NAME_KEYS, template.function_names):
+            self.update(key, value=function_name)
+        self.update_state(throttle_helper)
+        self.show_loco()
+
+    def get_template(self, throttle_helper: ThrottleHelper, image: Optional[PreparedImage]) -> RosterEntryTemplate:
+        """Returns the template for the helper's roster entry, making a new one if it hasn't been shown recently or has changed since."""
+        roster_entry = throttle_helper.roster_entry
+        roster_id = roster_entry["roster_id"]
+        template = self._templates.get(roster_id)
+        if template is None or not template.is_valid_for(roster_entry):
+            template = RosterEntryTemplate(throttle_helper, image)
+            self._templates[roster_id] = template
+            if len(self._templates) > MAX_TEMPLATES:
+                self._templates.popitem(last=False)
+        else:
+            self._templates.move_to_end(roster_id)
+            # The image is prepared separately, so a newer one replaces the template's, but one that isn't ready yet doesn't blank it.
+            if image is not None:
+                template.image = image
+        return template
+
+    def show_image(self, image: Optional[PreparedImage]):
+        if image:
+            self.update(KEY_IMAGE, data=image.png_bytes, size=image.size, visible=True)
+        else:
+            self.update(KEY_IMAGE, visible=False)
+
+    def show_loco(self):
+        self.update(KEY_HOME, visible=False)
+        self.update(KEY_LOCO, visible=True)
+
+    def update_state(self, throttle_helper: ThrottleHelper):
+        """Updates the live state of the loco (speed, direction and functions) in place."""
+        self.update(KEY_SPEED, value="" if throttle_helper.speed is None else throttle_helper.speed)
+        self.update(KEY_DIRECTION, value="Forward" if throttle_helper.direction == Direction.FORWARD else "Reverse")
+        # Only the labels of functions that have been switched on or off since the last update need recolouring.
+        functions = throttle_helper.functions
+        changed_functions = ALL_FUNCTIONS_MASK if self._rendered_functions is None else functions ^ self._rendered_functions
+        self._rendered_functions = functions
+        while changed_functions:
+            function_number = (changed_functions & -changed_functions).bit_length() - 1
+            colour = COLOUR_FUNCTION_ON if (functions >> function_number) & 0x01 else COLOUR_TEXT
+            self.update(FUNCTION_LABEL_KEYS[function_number], text_color=colour)
+            changed_functions &= changed_functions - 1
+        self.sparkline.update(throttle_helper.history, time.monotonic())
+
+    def refresh(self):
+        self.window.refresh()
+
+    def read_function_touches(self) -> List[Tuple[int, bool]]:
+        """Returns the function tiles pressed or released since the last call, in order, as (function number, whether it
+        was a press), without waiting."""
+        touches = []
+        while True:
+            event, _ = self.window.read(timeout=0)
+            if event == sg.TIMEOUT_EVENT or event == sg.WIN_CLOSED:
+                return touches
+            if event in FUNCTION_TOUCH_EVENTS:
+                touches.append(FUNCTION_TOUCH_EVENTS[event])
+
+    def close(self):
+        self.window.close()
@@ -0,0 +1,162 @@
+# A throttle display with no CAN interface of its own, showing a session published by main.py (see fanout.py).
+#
+# Show whichever session loco 6957 is in:  python src/display_client.py --address 6957
+# Connect to another machine:              python src/display_client.py --address 6957 --host cbus-pi.local
+import os
+import time
+import logging
+import asyncio
+import argparse
+from cbus_messages import Direction
+from display import SPARKLINE_INTERVAL, ThrottleDisplay, prepare_ui
+from fanout import FANOUT_PORT, FANOUT_SOCKET_PATH, MSG_FUNCTIONS, MSG_RELEASED, MSG_SPEED, MSG_STATE, STATE_STALE, FanoutClient
+from image_pipeline import ImagePipeline
+from log_config import LogConfig
+from render_scheduler import RenderScheduler
+from roster_cache import CACHE_DIRECTORY, RosterCache
+from speed_history import SpeedHistory
+from throttle_helper import ThrottleHelper
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# How long to wait before trying again when the server can't be reached or goes away.
+RECONNECT_INTERVAL = 5
+RENDER_FPS = 30
+
+throttle_helper = ThrottleHelper()
+throttle_display: ThrottleDisplay = None
+render_scheduler: RenderScheduler = None
+roster_client = None
+image_pipeline: ImagePipeline = None
+roster_fetch_task: asyncio.Task = None
+
+
+def show_home():
+    global roster_fetch_task
+    if roster_fetch_task:
+        roster_fetch_task.cancel()
+        roster_fetch_task = None
+    render_scheduler.cancel()
+    throttle_helper.release()
+    throttle_display.show_home()
+    throttle_display.refresh()
+
+
+async def fetch_roster_entry(address: int):
+    roster_entry = await roster_client.fetch_roster_entry(address)
+    if roster_entry is None:
+        throttle_display.show_no_roster_entry()
+        throttle_display.refresh()
+        return
+    image_bytes = await roster_client.fetch_image(roster_entry["roster_id"])
+    image = await image_pipeline.prepare(roster_entry["roster_id"], image_bytes) if image_bytes else None
+    throttle_helper.set_roster_entry(roster_entry, roster_client.get_function_index(roster_entry))
+    throttle_display.show_roster_entry(throttle_helper, image)
+    throttle_display.refresh()
+
+
+def process_message(message_type: int, fields: tuple):
+    global roster_fetch_task
+    if message_type == MSG_STATE:
+        _, address, speed, direction, functions, flags = fields
+        # A different loco, so everything about the old one has to go.
+        new_loco = address != throttle_helper.address
+        if new_loco:
+            show_home()
+            throttle_helper.set_address(address)
+            # The server doesn't send history, so the sparkline starts from when this display started showing the loco.
+            throttle_helper.history = SpeedHistory()
+        throttle_helper.direction = Direction(direction)
+        throttle_helper.functions = functions
+        if flags & STATE_STALE:
+            # The speed is out of date, so none is shown until the next MSG_SPEED.
+            throttle_helper.speed = None
+        else:
+            throttle_helper.speed = speed
+            throttle_helper.history.record(time.monotonic(), speed, throttle_helper.direction)
+        if new_loco:
+            throttle_display.show_provisional(throttle_helper)
+            throttle_display.refresh()
+            roster_fetch_task = asyncio.get_event_loop().create_task(fetch_roster_entry(address))
+            return
+    elif message_type == MSG_SPEED:
+        throttle_helper.speed = fields[1]
+        throttle_helper.direction = Direction(fields[2])
+        if throttle_helper.history:
+            throttle_helper.history.record(time.monotonic(), throttle_helper.speed, throttle_helper.direction)
+    elif message_type == MSG_FUNCTIONS:
+        throttle_helper.functions = fields[1]
+    elif message_type == MSG_RELEASED:
+        show_home()
+        return
+    render_scheduler.mark_dirty()
+
+
+async def tick_display():
+    # Keeps the speed sparkline scrolling while nothing else is changing.
+    while True:
+        await asyncio.sleep(SPARKLINE_INTERVAL)
+        if throttle_helper.address is not None:
+            render_scheduler.mark_dirty()
+
+
+def render_display():
+    throttle_display.update_state(throttle_helper)
+    throttle_display.refresh()
+
+
+async def receive(client: FanoutClient, session_id: int, address: int):
+    while True:
+        try:
+            await client.connect()
+            if address is not None:
+                await client.subscribe_address(address)
+            else:
+                await client.subscribe_session(session_id)
+            logging.info("Connected to session server")
+            async for message_type, fields in client.messages():
+                process_message(message_type, fields)
+            logging.warning("Session server closed the connection")
+        except (OSError, ValueError) as e:
+            logging.warning(f"Session server connection failed: {str(e)}")
+        finally:
+            client.close()
+        # Whatever was shown may now be out of date; the server sends the whole state again on reconnecting.
+        show_home()
+        await asyncio.sleep(RECONNECT_INTERVAL)
+
+
+if __name__ == "__main__":
+    log_config = LogConfig(LOG_LEVEL)
+    parser = argparse.ArgumentParser(description="Show a session published by another cbus-throttle-display process.")
+    subscription = parser.add_mutually_exclusive_group(required=True)
+    subscription.add_argument("--address", type=int, help="Show whichever session this loco address is in")
+    subscription.add_argument("--session", type=int, help="Show this session ID")
+    parser.add_argument("--path", default=FANOUT_SOCKET_PATH, help="The server's Unix socket")
+    parser.add_argument("--host", help="Connect to the server over TCP instead")
+    parser.add_argument("--port", type=int, default=FANOUT_PORT)
+    # A roster cache is only safe to use from one process, so each client on a host needs its own.
+    parser.add_argument("--cache-directory", help="Where to cache roster entries and images (by default, a directory for this subscription)")
+    args = parser.parse_args()
+    cache_directory = args.cache_directory or (f"{CACHE_DIRECTORY}-address-{args.address}" if args.address is not None else f"{CACHE_DIRECTORY}-session-{args.session}")
+
+    loop = asyncio.get_event_loop()
+    prepare_ui()
+    throttle_display = ThrottleDisplay()
+    # Imported once the home screen is up, as importing requests is slow on a Pi.
+    from roster import RosterClient
+    roster_cache = RosterCache(cache_directory)
+    roster_client = RosterClient(cache=roster_cache)
+    image_pipeline = ImagePipeline(roster_cache)
+    render_scheduler = RenderScheduler(render_display, RENDER_FPS, loop)
+    client = FanoutClient(args.path, args.host, args.port)
+    loop.create_task(tick_display())
+    try:
+        loop.run_until_complete(receive(client, args.session, args.address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        roster_client.close()
+        image_pipeline.close()
+        roster_cache.save_recency()
+        throttle_display.close()
+        log_config.stop()
@@ -0,0 +1,234 @@
+# Publishing session state to other displays, so one process (and one CAN interface) per bus can serve any number of screens.
+#
+# The protocol is a stream of messages, each a type byte followed by a fixed-size payload (see PAYLOADS), little-endian.
+# A client sends one subscription (for a session ID, or for a loco address whichever session it is in) and can replace it at
+# any time. The server answers with the current state of the matching session, if there is one, then sends a message each
+# time that session changes: the whole state when a PLOC arrives, and just what changed for DSPD and DFUN. A state can be
+# flagged as stale (STATE_STALE), if the session's changes weren't being received until now (see Session.stale): its speed
+# is then out of date and its functions unknown, until the next MSG_SPEED or MSG_STATE.
+import os
+import struct
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Dict, Optional, Set, Tuple
+from cbus_messages import CbusMessage, CbusMessageEngineReport, CbusMessageSetEngineFunctions, CbusMessageSetEngineSpeedDir
+from sessions import Session, SessionTable
+
+FANOUT_SOCKET_PATH = "/tmp/cbus-throttle-display-fanout.sock"
+FANOUT_PORT = 5550
+
+# Client to server.
+MSG_SUBSCRIBE_SESSION = 0x01    # Session ID.
+MSG_SUBSCRIBE_ADDRESS = 0x02    # Loco address.
+# Server to client.
+MSG_STATE = 0x10                # Session ID, address, speed (-1 for an emergency stop), direction, functions (bit n is Fn), flags.
+MSG_SPEED = 0x11                # Session ID, speed (-1 for an emergency stop), direction.
+MSG_FUNCTIONS = 0x12            # Session ID, functions.
+MSG_RELEASED = 0x13             # Session ID, address.
+
+# MSG_STATE flags.
+STATE_STALE = 0x01
+
+PAYLOADS: Dict[int, struct.Struct] = {
+    MSG_SUBSCRIBE_SESSION: struct.Struct("<B"),
+    MSG_SUBSCRIBE_ADDRESS: struct.Struct("<H"),
+    MSG_STATE: struct.Struct("<BHbBIB"),
+    MSG_SPEED: struct.Struct("<BbB"),
+    MSG_FUNCTIONS: struct.Struct("<BI"),
+    MSG_RELEASED: struct.Struct("<BH"),
+}
+
+# A client that falls this far behind (e.g. it has stopped reading) is disconnected rather than buffered for without limit.
+# It gets the whole state again when it reconnects, so nothing is lost but the updates in between.
+MAX_CLIENT_BUFFER = 64 * 1024
+
+
+def encode(message_type: int, *fields: int) -> bytes:
+    return bytes((message_type,)) + PAYLOADS[message_type].pack(*fields)
+
+
+async def read_message(reader: asyncio.StreamReader) -> Tuple[int, Tuple[int, ...]]:
+    """Reads one message, returning its type and fields. Raises asyncio.IncompleteReadError when the stream ends, or ValueError for an unknown type."""
+    message_type = (await reader.readexactly(1))[0]
+    payload = PAYLOADS.get(message_type)
+    if payload is None:
+        raise ValueError(f"Unknown message type 0x{message_type:02X}")
+    return message_type, payload.unpack(await reader.readexactly(payload.size))
+
+
+def encode_state(session: Session) -> bytes:
+    return encode(MSG_STATE, session.session_id, session.address, session.speed, session.direction, session.functions, STATE_STALE if session.stale else 0)
+
+
+class Subscriber:
+
+    __slots__ = ("writer", "session_id", "address")
+
+    writer: asyncio.StreamWriter
+    session_id: Optional[int]
+    address: Optional[int]
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.session_id = None
+        self.address = None
+
+    def matches(self, session: Session) -> bool:
+        return session.session_id == self.session_id or session.address == self.address
+
+
+class FanoutServer:
+    """Publishes changes to the sessions in a session table to subscribed display clients (see FanoutClient).
+
+    Messages are encoded once, however many clients they go to, and writing never waits for a client: one that can't keep
+    up is disconnected instead."""
+
+    session_table: SessionTable
+    # Called whenever a client subscribes, changes its subscription or goes away (see get_subscribed_session_ids).
+    on_subscriptions_changed: Optional[Callable[[], None]]
+    _subscribers: Set[Subscriber]
+    _servers: list
+
+    def __init__(self, session_table: SessionTable, on_subscriptions_changed: Optional[Callable[[], None]] = None):
+        self.session_table = session_table
+        self.on_subscriptions_changed = on_subscriptions_changed
+        self._subscribers = set()
+        self._servers = []
+
+    async def serve(self, path: str = FANOUT_SOCKET_PATH):
+        if os.path.exists(path):
+            os.remove(path)
+        self._servers.append(await asyncio.start_unix_server(self.handle_connection, path))
+        logging.info(f"Publishing sessions on {path}")
+
+    async def serve_tcp(self, host: Optional[str] = None, port: int = FANOUT_PORT):
+        self._servers.append(await asyncio.start_server(self.handle_connection, host, port))
+        logging.info(f"Publishing sessions on port {port}")
+
+    def close(self):
+        for server in self._servers:
+            server.close()
+        for subscriber in list(self._subscribers):
+            subscriber.writer.close()
+        self._subscribers.clear()
+
+    def get_subscribed_session_ids(self) -> Set[int]:
+        """Returns the IDs of the sessions that any client is currently subscribed to."""
+        session_ids = set()
+        for subscriber in self._subscribers:
+            if subscriber.session_id is not None:
+                session_ids.add(subscriber.session_id)
+            else:
+                session = self.session_table.get_by_address(subscriber.address)
+                if session is not None:
+                    session_ids.add(session.session_id)
+        return session_ids
+
+    def subscriptions_changed(self):
+        if self.on_subscriptions_changed:
+            self.on_subscriptions_changed()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscriber = Subscriber(writer)
+        self._subscribers.add(subscriber)
+        try:
+            while True:
+                message_type, fields = await read_message(reader)
+                if message_type == MSG_SUBSCRIBE_SESSION:
+                    subscriber.session_id, subscriber.address = fields[0], None
+                    session = self.session_table.get(subscriber.session_id)
+                elif message_type == MSG_SUBSCRIBE_ADDRESS:
+                    subscriber.session_id, subscriber.address = None, fields[0]
+                    session = self.session_table.get_by_address(subscriber.address)
+                else:
+                    raise ValueError(f"Unexpected message type 0x{message_type:02X}")
+                self.subscriptions_changed()
+                if session is not None:
+                    self.send(subscriber, encode_state(session))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
+            logging.warning(f"Disconnecting display client: {str(e)}")
+        finally:
+            if subscriber in self._subscribers:
+                self._subscribers.discard(subscriber)
+                self.subscriptions_changed()
+            writer.close()
+
+    def publish(self, cbus_message: CbusMessage, session: Session):
+        """Sends whatever a message (already applied to the session table) changed to the clients subscribed to its session."""
+        if not self._subscribers:
+            return
+        if isinstance(cbus_message, CbusMessageSetEngineSpeedDir):
+            data = encode(MSG_SPEED, session.session_id, session.speed, session.direction)
+        elif isinstance(cbus_message, CbusMessageSetEngineFunctions):
+            data = encode(MSG_FUNCTIONS, session.session_id, session.functions)
+        elif isinstance(cbus_message, CbusMessageEngineReport):
+            data = encode_state(session)
+        else:
+            return
+        self.send_to_matching(session, data)
+
+    def session_removed(self, session: Session):
+        if self._subscribers:
+            self.send_to_matching(session, encode(MSG_RELEASED, session.session_id, session.address))
+
+    def send_to_matching(self, session: Session, data: bytes):
+        for subscriber in list(self._subscribers):
+            if subscriber.matches(session):
+                self.send(subscriber, data)
+
+    def send(self, subscriber: Subscriber, data: bytes):
+        writer = subscriber.writer
+        if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+            logging.warning("Disconnecting display client that is not keeping up")
+            self._subscribers.discard(subscriber)
+            self.subscriptions_changed()
+            writer.close()
+            return
+        writer.write(data)
+
+    def get_stats(self) -> dict:
+        return { "clients": len(self._subscribers) }
+
+
+class FanoutClient:
+    """Receives session state from a FanoutServer, for a display that has no CAN interface of its own."""
+
+    path: Optional[str]
+    host: Optional[str]
+    port: int
+    reader: asyncio.StreamReader = None
+    writer: asyncio.StreamWriter = None
+
+    def __init__(self, path: Optional[str] = FANOUT_SOCKET_PATH, host: Optional[str] = None, port: int = FANOUT_PORT):
+        """Connects to the server's Unix socket at path, or if host is given, to its TCP port."""
+        self.path = path
+        self.host = host
+        self.port = port
+
+    async def connect(self):
+        if self.host:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        else:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+    async def subscribe_session(self, session_id: int):
+        self.writer.write(encode(MSG_SUBSCRIBE_SESSION, session_id))
+        await self.writer.drain()
+
+    async def subscribe_address(self, address: int):
+        self.writer.write(encode(MSG_SUBSCRIBE_ADDRESS, address))
+        await self.writer.drain()
+
+    async def messages(self) -> AsyncIterator[Tuple[int, Tuple[int, ...]]]:
+        """Yields each message from the server as its type and fields, until the connection closes."""
+        while True:
+            try:
+                yield await read_message(self.reader)
+            except asyncio.IncompleteReadError:
+                return
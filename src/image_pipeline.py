@@ -0,0 +1,116 @@
+import zlib
+import struct
+import asyncio
+import logging
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from roster_cache import KIND_RENDERED_IMAGE, CacheItem, RosterCache
+
+# The box on the display that roster images are fitted into.
+IMAGE_BOX = (500, 400)
+# Bilinear is plenty for downscaling photos to this size, and much cheaper than Lanczos on a Pi.
+RESAMPLING_FILTER = "BILINEAR"
+# Speed matters more than size for the cached PNGs.
+PNG_COMPRESS_LEVEL = 1
+# Image modes that can be saved as PNG without converting them first.
+PNG_MODES = ("1", "L", "LA", "P", "RGB", "RGBA")
+
+
+class PreparedImage:
+
+    __slots__ = ("png_bytes", "size")
+
+    png_bytes: bytes
+    size: Tuple[int, int]
+
+    def __init__(self, png_bytes: bytes, size: Tuple[int, int]):
+        self.png_bytes = png_bytes
+        self.size = size
+
+
+def get_png_size(png_bytes: bytes) -> Tuple[int, int]:
+    # The width and height are the first two fields of the IHDR chunk, which always directly follows the 8-byte signature.
+    return struct.unpack(">II", png_bytes[16:24])
+
+
+def fit_to_box(size: Tuple[int, int], box: Tuple[int, int]) -> Tuple[int, int]:
+    width, height = size
+    scale = min(box[0] / width, box[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def render_image(image_bytes: bytes, box: Tuple[int, int] = IMAGE_BOX) -> PreparedImage:
+    """Decodes an image and resizes it to fit the box, returning it as PNG ready to be displayed."""
+    # Pillow is slow to import, so it is left until the first image is decoded (on the pipeline's worker thread) rather than holding up startup.
+    from PIL import Image
+    with Image.open(BytesIO(image_bytes)) as image:
+        size = fit_to_box(image.size, box)
+        # For JPEGs this lets the decoder scale down while decoding, which is far cheaper than decoding at full size.
+        image.draft("RGB", size)
+        if image.mode not in PNG_MODES:
+            image = image.convert("RGB")
+        if image.size != size:
+            image = image.resize(size, Image.Resampling[RESAMPLING_FILTER])
+        png_bytes = BytesIO()
+        image.save(png_bytes, format="png", compress_level=PNG_COMPRESS_LEVEL)
+        return PreparedImage(png_bytes.getvalue(), size)
+
+
+class ImagePipeline:
+    """Prepares roster images for display on a worker thread, so decoding never freezes the asyncio loop.
+
+    Prepared images are kept in the roster cache, keyed by roster ID and a checksum of the source image (so they are
+    invalidated when the image changes), so a loco that has been displayed before never needs decoding again."""
+
+    cache: Optional[RosterCache]
+    executor: ThreadPoolExecutor
+    # Roster ID -> the source image its key was last worked out for, and that key. The roster cache hands back the same
+    # bytes object for an image it holds in memory, so a recent loco's image doesn't need checksumming again.
+    _keys: Dict[str, Tuple[bytes, str]]
+
+    def __init__(self, cache: Optional[RosterCache] = None):
+        self.cache = cache
+        self._keys = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image")
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def get_key(self, roster_id: str, image_bytes: bytes) -> str:
+        known = self._keys.get(roster_id)
+        if known is not None and known[0] is image_bytes:
+            return known[1]
+        key = f"{roster_id}_{IMAGE_BOX[0]}x{IMAGE_BOX[1]}_{zlib.crc32(image_bytes):08x}"
+        self._keys[roster_id] = (image_bytes, key)
+        return key
+
+    def get_cached(self, roster_id: str, image_bytes: bytes) -> Optional[PreparedImage]:
+        """Returns the prepared image if it is in the cache, without decoding anything."""
+        cached = self.cache.get(KIND_RENDERED_IMAGE, self.get_key(roster_id, image_bytes)) if self.cache else None
+        return PreparedImage(cached.data, get_png_size(cached.data)) if cached and cached.data else None
+
+    def is_unreadable(self, roster_id: str, image_bytes: bytes) -> bool:
+        """Returns whether the image is already known (from an earlier attempt) to be unreadable, without decoding anything."""
+        cached = self.cache.get(KIND_RENDERED_IMAGE, self.get_key(roster_id, image_bytes)) if self.cache else None
+        return cached is not None and not cached.data
+
+    async def prepare(self, roster_id: str, image_bytes: bytes) -> Optional[PreparedImage]:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.prepare_blocking, roster_id, image_bytes)
+
+    def prepare_blocking(self, roster_id: str, image_bytes: bytes) -> Optional[PreparedImage]:
+        image = self.get_cached(roster_id, image_bytes)
+        if image or self.is_unreadable(roster_id, image_bytes):
+            return image
+        try:
+            image = render_image(image_bytes)
+        # Pillow raises UnidentifiedImageError, an OSError, for anything it can't read.
+        except OSError as e:
+            logging.info(f"Image for roster entry with ID {roster_id} could not be read: {str(e)}")
+            # Remembered as an empty item, so it isn't tried again.
+            if self.cache:
+                self.cache.put(KIND_RENDERED_IMAGE, self.get_key(roster_id, image_bytes), CacheItem(b""))
+            return None
+        if self.cache:
+            self.cache.put(KIND_RENDERED_IMAGE, self.get_key(roster_id, image_bytes), CacheItem(image.png_bytes))
+        return image
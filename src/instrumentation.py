@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable, Dict, List
+from cbus_messages import CbusOpcode
+
+# Histogram bucket upper bounds in seconds: 8 per decade, from 1µs to 10s. Anything slower goes in a final overflow bucket.
+BUCKET_BOUNDS = tuple(1e-6 * 10 ** (i / 8) for i in range(57))
+# Percentiles cover the current window and the one before it, so they always reflect between one and two windows of history.
+ROLLING_WINDOW = 60.0
+
+METRICS_SOCKET_PATH = "/tmp/cbus-throttle-display.sock"
+
+# The stages of the hot path that are timed.
+STAGE_RECEIVE_QUEUE = "receive_queue"       # Kernel timestamp to the frame reaching Python.
+STAGE_DECODE = "decode"
+STAGE_DISPATCH = "dispatch"                 # Session table and display logic for a decoded message.
+STAGE_ROSTER_FETCH = "roster_fetch"
+STAGE_RENDER = "render"                     # Updating and refreshing the window.
+STAGE_FRAME_TO_PIXEL = "frame_to_pixel"     # The oldest frame in a repaint reaching Python, to that repaint finishing.
+
+
+class LatencyHistogram:
+    """A rolling latency histogram with fixed, log-spaced buckets, so recording is a bisect and an increment with no allocation."""
+
+    __slots__ = ("counts", "previous_counts", "window_start", "total", "max")
+
+    counts: List[int]
+    previous_counts: List[int]
+    window_start: float
+    total: int
+    max: float
+
+    def __init__(self, now: float):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.previous_counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.window_start = now
+        self.total = 0
+        self.max = 0.0
+
+    def record(self, seconds: float, now: float):
+        if now - self.window_start >= ROLLING_WINDOW:
+            self.rotate(now)
+        self.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.total += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def rotate(self, now: float):
+        # If more than a whole window has passed, the current window is too old to keep either.
+        if now - self.window_start >= 2 * ROLLING_WINDOW:
+            self.previous_counts = [0] * len(self.counts)
+        else:
+            self.previous_counts = self.counts
+        self.counts = [0] * len(self.previous_counts)
+        self.window_start = now
+
+    def get_percentile(self, percentile: float) -> float:
+        """Returns the upper bound of the bucket holding the given percentile, or 0 if nothing has been recorded recently."""
+        counts = [current + previous for current, previous in zip(self.counts, self.previous_counts)]
+        n_samples = sum(counts)
+        if n_samples == 0:
+            return 0.0
+        rank = n_samples * percentile / 100
+        cumulative = 0
+        for bucket, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(BUCKET_BOUNDS[bucket], self.max) if bucket < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def get_stats(self) -> dict:
+        return {
+            "count": self.total,
+            "p50_ms": self.get_percentile(50) * 1000,
+            "p99_ms": self.get_percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class Metrics:
+    """Lightweight counters and latency histograms for the hot path, cheap enough to leave on in production."""
+
+    start_time: float
+    # Frames received, indexed by opcode.
+    frame_counts: List[int]
+    # Frames that were received but thrown away without being handled (e.g. by a session filter).
+    dropped_frames: int
+    # Frames with an opcode we understand, but too short to be decoded.
+    short_frames: int
+    histograms: Dict[str, LatencyHistogram]
+    # Name -> function returning a dict of further stats to include (e.g. the render scheduler's counters).
+    stats_providers: Dict[str, Callable[[], dict]]
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.frame_counts = [0] * 256
+        self.dropped_frames = 0
+        self.short_frames = 0
+        self.histograms = {}
+        self.stats_providers = {}
+
+    def record(self, stage: str, seconds: float):
+        now = time.monotonic()
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram(now)
+        histogram.record(seconds, now)
+
+    def add_stats_provider(self, name: str, provider: Callable[[], dict]):
+        self.stats_providers[name] = provider
+
+    def get_stats(self) -> dict:
+        frames = {}
+        for op_code, count in enumerate(self.frame_counts):
+            if count:
+                frames[CbusOpcode(op_code).name if op_code in CbusOpcode._value2member_map_ else f"0x{op_code:02X}"] = count
+        stats = {
+            "uptime_s": time.monotonic() - self.start_time,
+            "frames": frames,
+            "dropped_frames": self.dropped_frames,
+            "short_frames": self.short_frames,
+            "latency": {stage: histogram.get_stats() for stage, histogram in self.histograms.items()},
+        }
+        for name, provider in self.stats_providers.items():
+            stats[name] = provider()
+        return stats
+
+    def log_stats(self):
+        logging.info("Metrics: %s", json.dumps(self.get_stats()))
+
+    async def serve(self, path: str = METRICS_SOCKET_PATH) -> asyncio.AbstractServer:
+        """Serves the current stats as JSON to anything that connects to a Unix socket, e.g. `socat - UNIX-CONNECT:/tmp/cbus-throttle-display.sock`."""
+        async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            writer.write(json.dumps(self.get_stats(), indent=2).encode() + b"\n")
+            await writer.drain()
+            writer.close()
+
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(handle_connection, path)
+        logging.debug(f"Serving metrics on {path}")
+        return server
+
+
+# The metrics for this process.
+metrics = Metrics()
@@ -0,0 +1,103 @@
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Tuple
+from rich.logging import RichHandler
+
+# How many records can be waiting for the listener thread before new ones are dropped rather than blocking the caller.
+QUEUE_SIZE = 10000
+# At most this many DEBUG records per second are let through from any one line of code; the rest are counted and dropped.
+# Per-frame debug logging is therefore sampled during a burst of traffic, while occasional debug messages are unaffected.
+DEBUG_RATE_LIMIT = 5
+
+
+class DroppingQueueHandler(QueueHandler):
+    """A QueueHandler that drops (and counts) records when the queue is full, so logging can never block the event loop."""
+
+    n_dropped: int
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.n_dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.n_dropped += 1
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Rate-limits DEBUG records per call site, noting on the next record let through how many were suppressed."""
+
+    rate_limit: int
+    # (path, line) -> (start of the current one-second window, records let through in it, records suppressed since the last one let through)
+    _call_sites: Dict[Tuple[str, int], Tuple[float, int, int]]
+
+    def __init__(self, rate_limit: int = DEBUG_RATE_LIMIT):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self._call_sites = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        call_site = (record.pathname, record.lineno)
+        now = record.created
+        window_start, n_passed, n_suppressed = self._call_sites.get(call_site, (now, 0, 0))
+        if now - window_start >= 1.0:
+            window_start, n_passed = now, 0
+        if n_passed >= self.rate_limit:
+            self._call_sites[call_site] = (window_start, n_passed, n_suppressed + 1)
+            return False
+        if n_suppressed:
+            record.msg = f"{record.msg} [{n_suppressed} similar messages suppressed]"
+        self._call_sites[call_site] = (window_start, n_passed + 1, 0)
+        return True
+
+
+class LogConfig:
+    """Logging for the application: records are queued by the caller and formatted and written by Rich on a listener thread."""
+
+    queue_handler: DroppingQueueHandler
+    listener: QueueListener
+    level: int
+
+    def __init__(self, level: str):
+        log_queue = queue.Queue(QUEUE_SIZE)
+        self.queue_handler = DroppingQueueHandler(log_queue)
+        self.queue_handler.addFilter(DebugSamplingFilter())
+        rich_handler = RichHandler(omit_repeated_times=False)
+        rich_handler.setFormatter(logging.Formatter("%(message)s", datefmt="[%X]"))
+        self.listener = QueueListener(log_queue, rich_handler, respect_handler_level=True)
+        logging.basicConfig(format="%(message)s", handlers=[self.queue_handler], force=True)
+        self.set_level(level)
+        self.listener.start()
+
+    def set_level(self, level):
+        """Sets the level, given as a number or a name in any case (e.g. "debug"). An unknown name leaves logging at INFO."""
+        if isinstance(level, str):
+            name = level
+            level = logging.getLevelName(name.upper())
+            if not isinstance(level, int):
+                level = logging.INFO
+                logging.getLogger().setLevel(level)
+                logging.warning("Unknown log level %s, using INFO", name)
+        self.level = level
+        logging.getLogger().setLevel(self.level)
+
+    def toggle_debug(self, initial_level):
+        """Switches between DEBUG and the given level (or INFO, if that is DEBUG too), e.g. from a signal handler, without restarting."""
+        if self.level != logging.DEBUG:
+            self.set_level(logging.DEBUG)
+        else:
+            self.set_level(initial_level)
+            if self.level == logging.DEBUG:
+                self.set_level(logging.INFO)
+        logging.warning("Log level is now %s", logging.getLevelName(self.level))
+
+    def get_stats(self) -> dict:
+        return { "level": logging.getLevelName(self.level), "queued": self.queue_handler.queue.qsize(), "dropped": self.queue_handler.n_dropped }
+
+    def stop(self):
+        self.listener.stop()
@@ -1,42 +1,78 @@
-from gettext import install
 import sys
 import os
 import logging
 import asyncio
 import signal
-from turtle import width
-from rich.logging import RichHandler
+import time
+from typing import TYPE_CHECKING
 from cbus import CbusInterface
-from cbus_messages import CbusMessage, CbusMessageEngineReport, CbusMessageRequestEngineSession, CbusMessageSetEngineFunctions, CbusMessageSetEngineSpeedDir, CbusMessageReleaseEngine, CbusSessionMessage, Direction, FunctionState
+from cbus_log import CbusLogWriter
+from cbus_messages import FUNCTION_RANGE_BY_NUMBER, FUNCTION_RANGE_MASKS, CbusMessage, CbusMessageEngineReport, CbusMessageRequestEngineSession, CbusMessageSetEngineFunctions, CbusMessageSetEngineSpeedDir, CbusSessionMessage, Direction, FunctionState
+from sessions import Session, SessionTable
 from throttle_helper import ThrottleHelper
-import PySimpleGUI as sg
-import textwrap
-from PIL import Image, UnidentifiedImageError
-from io import BytesIO
-import requests
-
-DEBUG = True
+from display import SPARKLINE_INTERVAL, ThrottleDisplay, prepare_ui
+from image_pipeline import ImagePipeline
+from log_config import LogConfig
+from instrumentation import STAGE_FRAME_TO_PIXEL, STAGE_RENDER, STAGE_ROSTER_FETCH, metrics
+from render_scheduler import RenderScheduler
+from fanout import FanoutServer
+from session_snapshot import SNAPSHOT_INTERVAL, SessionSnapshot
+from roster_cache import RosterCache
+from roster_index import RosterIndex
+from sd_notify import notify
+
+if TYPE_CHECKING:
+    from roster import RosterClient
+
+# The log level at startup. Send SIGUSR2 to toggle DEBUG logging on and off without restarting.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 CAN_INTERFACE = "can0"
 CAN_BITRATE = 125000
+# The python-can interface to use. "virtual" (with a replayed log, see cbus_log.py) allows running without CAN hardware.
+CAN_BUSTYPE = "socketcan"
+# If set, all raw CAN traffic is also captured to this file (see cbus_log.py for replaying it).
+CAPTURE_PATH = None
+
+# Whether to pull the whole roster into memory at startup (and then periodically), so locos can be displayed without waiting for the roster server.
+ROSTER_PREFETCH = True
+ROSTER_REFRESH_INTERVAL = 15 * 60
+
+# The display is repainted at most this many times a second, however fast updates arrive from the bus.
+RENDER_FPS = 30
 
-MAX_FUNCTIONS = 28
+# The display only sends on the bus if it is given a CAN ID, which must be different for every node on the bus (e.g. CAN_ID=0x7D).
+# It then toggles a function when its tile is tapped, and keeps the displayed session alive with DKEEP.
+CAN_ID = int(os.environ["CAN_ID"], 0) if os.environ.get("CAN_ID") else None
+KEEP_ALIVE_INTERVAL = 4.0
+# How often taps on the display are checked for.
+TAP_POLL_INTERVAL = 0.05
 
-FONT_H1 = "_ 30"
-FONT_H2 = "_ 24"
-FONT_H3 = "_ 18"
-FONT_H4 = "_ 16"
-FONT_BODY  = "_ 12"
-FONT_LABEL = "_ 10 bold"
-FONT_VALUE = "_ 14"
+# If set, session state is also published for other displays (see display_client.py) on this Unix socket and/or TCP port.
+FANOUT_SOCKET_PATH = None
+FANOUT_PORT = None
 
 cbus_interface: CbusInterface
 
-pending_address: str = None
+# The ID of the session currently being shown on the display.
 session_id: int = None
 
 throttle_helper = ThrottleHelper()
 
-roster_entry_window: sg.Window = None
+# Set up by start_roster(), once the home screen is showing.
+roster_cache: RosterCache = None
+roster_client: "RosterClient" = None
+image_pipeline: ImagePipeline = None
+# The in-flight roster fetch for the displayed session, if any.
+roster_fetch_task: asyncio.Task = None
+
+throttle_display: ThrottleDisplay = None
+render_scheduler: RenderScheduler = None
+# When the oldest frame not yet shown on the display reached Python, for measuring frame-to-pixel latency.
+dirty_since: float = None
+
+fanout_server: FanoutServer = None
+
+session_snapshot = SessionSnapshot()
 
 def is_session_set() -> bool:
     return session_id is not None
@@ -51,148 +87,281 @@ def is_session_message_relevant(session_message: CbusSessionMessage) -> bool:
     return session_message.session_id == session_id
 
 
-def update_throttle_helper_from_engine_report(engine_report_message: CbusMessageEngineReport):
-    throttle_helper.speed = engine_report_message.speed
-    throttle_helper.direction = engine_report_message.direction
-    throttle_helper.set_function_states(engine_report_message.functions)
+def update_throttle_helper_from_session(session: Session):
+    # A stale session's speed may be long out of date, so none is shown until a DSPD or PLOC arrives.
+    throttle_helper.speed = None if session.stale else session.speed
+    throttle_helper.direction = session.direction
+    throttle_helper.functions = session.functions
+    throttle_helper.history = session.history
+
+
+def release_session():
+    global dirty_since
+    cancel_roster_fetch()
+    render_scheduler.cancel()
+    dirty_since = None
+    throttle_helper.release()
+    set_session_id(None)
+    # Speed and function changes for every session are wanted again, so that the next session to be displayed is up to date.
+    update_session_filter()
+    throttle_display.show_home()
+    throttle_display.refresh()
+
+
+def update_session_filter():
+    """While a session is displayed, only lets through speed and function changes for the sessions someone is watching: that
+    one, and any that fan-out clients are subscribed to."""
+    if not is_session_set():
+        session_ids = None
+    else:
+        session_ids = {session_id}
+        if fanout_server:
+            session_ids |= fanout_server.get_subscribed_session_ids()
+    cbus_interface.set_session_filter(session_ids)
+    # Sessions outside the filter stop being updated, so the table marks them stale.
+    session_table.set_tracked(session_ids)
+
+
+def switch_session(id: int):
+    """Shows a different active session on the display, using the state already held in the session table."""
+    session = session_table.get(id)
+    if session is None:
+        logging.warning("Cannot switch to session %d, as it is not active", id)
+        return
+    if is_session_set():
+        release_session()
+    set_session_id(id)
+    # Drop speed and function changes for every other session before they reach the loop.
+    update_session_filter()
+    throttle_helper.set_address(session.address)
+    update_throttle_helper_from_session(session)
+    # If we have seen this loco recently, everything needed is already in the cache, so display it without any network I/O.
+    roster_entry = roster_client.get_cached_roster_entry(session.address)
+    if roster_entry:
+        roster_id = roster_entry["roster_id"]
+        # None until it is known whether the loco has an image at all, and empty (roster.NO_IMAGE) if it is known not to.
+        image_bytes = roster_client.get_cached_image(roster_id)
+        image = image_pipeline.get_cached(roster_id, image_bytes) if image_bytes else None
+        if image or image_bytes == b"" or (image_bytes and image_pipeline.is_unreadable(roster_id, image_bytes)):
+            throttle_helper.set_roster_entry(roster_entry, roster_client.get_function_index(roster_entry))
+            throttle_display.show_roster_entry(throttle_helper, image)
+            throttle_display.refresh()
+            return
+    # Show what the PLOC has already told us straight away, and fill in the roster details once they arrive.
+    throttle_display.show_provisional(throttle_helper)
+    throttle_display.refresh()
+    start_roster_fetch(session.address)
+
+
+def start_roster():
+    """Sets up roster lookups. This is left until the home screen is showing, as importing requests is slow on a Pi."""
+    global roster_cache, roster_client, image_pipeline
+    from roster import RosterClient
+    roster_cache = RosterCache()
+    roster_client = RosterClient(cache=roster_cache, index=RosterIndex() if ROSTER_PREFETCH else None)
+    image_pipeline = ImagePipeline(roster_cache)
+
+
+async def start_listening():
+    await cbus_interface.listen(cbus_message_listener, [CbusLogWriter(CAPTURE_PATH)] if CAPTURE_PATH else [])
+    # Only now is startup complete: if systemd started us as a Type=notify service, it waits for this before considering us running.
+    notify("READY=1", f"STATUS=Listening to {CAN_INTERFACE}")
+    if CAN_ID is not None:
+        loop = asyncio.get_event_loop()
+        loop.create_task(handle_taps())
+        loop.create_task(keep_session_alive())
+        metrics.add_stats_provider("writer", cbus_interface.writer.get_stats)
+
+
+async def handle_taps():
+    while True:
+        await asyncio.sleep(TAP_POLL_INTERVAL)
+        for function_number, pressed in throttle_display.read_function_touches():
+            handle_function_touch(function_number, pressed)
+
+
+def handle_function_touch(function_number: int, pressed: bool):
+    session = session_table.get(session_id) if is_session_set() else None
+    if session is None:
+        return
+    function = throttle_helper.get_function(function_number)
+    if function is not None and not function["lockable"]:
+        # Momentary (e.g. a horn), so only on while its tile is held.
+        set_function(session, function_number, pressed, momentary=True)
+    elif pressed:
+        set_function(session, function_number, not session.get_function_state(function_number))
+
+
+def set_function(session: Session, function_number: int, state: bool, momentary: bool = False):
+    # A DFUN sets every function in its range, so tapping one whose neighbours haven't been seen yet could switch them off.
+    unknown_functions = FUNCTION_RANGE_MASKS[FUNCTION_RANGE_BY_NUMBER[function_number]] & ~session.known_functions
+    if unknown_functions:
+        logging.warning("Ignoring tap on F%d, as the states of %s aren't known yet", function_number,
+            ", ".join(f"F{n}" for n in range(unknown_functions.bit_length()) if (unknown_functions >> n) & 0x01))
+        return
+    functions = session.functions | (1 << function_number) if state else session.functions & ~(1 << function_number)
+    # The DFUN is echoed back through cbus_message_listener, which updates the session and the display as for any other.
+    if not cbus_interface.send_functions(session.session_id, functions, function_number, coalesce=not momentary):
+        logging.warning("Too much waiting to be sent on the bus, ignoring tap on F%d", function_number)
+
+
+async def keep_session_alive():
+    while True:
+        await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+        if is_session_set():
+            cbus_interface.send_keep_alive(session_id)
+
+
+def restore_sessions():
+    """Picks up the sessions (and the one being displayed) from before a restart, so the operator doesn't have to re-acquire the loco."""
+    sessions, displayed_session_id = session_snapshot.load(session_table.clock())
+    for session in sessions:
+        session_table.restore(session)
+    if sessions:
+        logging.info("Restored %d sessions from snapshot", len(sessions))
+    if displayed_session_id is not None and session_table.get(displayed_session_id):
+        switch_session(displayed_session_id)
+
+
+async def tick_display():
+    # Keeps the speed sparkline scrolling while nothing else is changing.
+    while True:
+        await asyncio.sleep(SPARKLINE_INTERVAL)
+        if is_session_set():
+            render_scheduler.mark_dirty()
+
+
+async def save_sessions():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        # Sessions are otherwise only evicted as messages arrive, so on a quiet bus (e.g. with the command station off) a
+        # restored session the bus never confirms would stay forever.
+        session_table.evict_stale()
+        session_snapshot.save(session_table, session_id)
+
+
+def start_roster_fetch(address: int):
+    global roster_fetch_task
+    cancel_roster_fetch()
+    roster_fetch_task = asyncio.get_event_loop().create_task(fetch_roster_entry(address))
+
+
+def cancel_roster_fetch():
+    if roster_fetch_task and not roster_fetch_task.done():
+        logging.debug("Cancelling roster fetch for address %s", throttle_helper.address)
+        roster_fetch_task.cancel()
+
+
+async def refresh_roster_index():
+    await roster_client.load_roster_index()
+    while True:
+        await roster_client.fetch_roster_index()
+        await asyncio.sleep(ROSTER_REFRESH_INTERVAL)
+
+
+def prefetch_roster_image(address: int):
+    # An RLOC has been seen, so the PLOC for this address is probably on its way. If the roster index already knows the loco, get its image into the cache now so it can be displayed the moment the PLOC arrives.
+    roster_entry = roster_client.index.get(address) if roster_client.index else None
+    if roster_entry and roster_client.get_cached_image(roster_entry["roster_id"]) is None:
+        asyncio.get_event_loop().create_task(prepare_roster_image(roster_entry["roster_id"]))
+
+
+async def prepare_roster_image(roster_id: str):
+    image_bytes = await roster_client.fetch_image(roster_id)
+    if image_bytes:
+        await image_pipeline.prepare(roster_id, image_bytes)
+
+
+async def fetch_roster_entry(address: int):
+    start = time.perf_counter()
+    roster_entry = await roster_client.fetch_roster_entry(address)
+    if roster_entry is None:
+        # Not in the roster, or the roster server can't be reached and there is no cached copy.
+        throttle_display.show_no_roster_entry()
+        throttle_display.refresh()
+        return
+    image_bytes = await roster_client.fetch_image(roster_entry["roster_id"])
+    metrics.record(STAGE_ROSTER_FETCH, time.perf_counter() - start)
+    # Decoding and resizing happen on the image pipeline's worker thread, so the loop is free while they do.
+    image = await image_pipeline.prepare(roster_entry["roster_id"], image_bytes) if image_bytes else None
+    throttle_helper.set_roster_entry(roster_entry, roster_client.get_function_index(roster_entry))
+    throttle_display.show_roster_entry(throttle_helper, image)
+    throttle_display.refresh()
+
+
+def session_removed(session: Session):
+    if fanout_server:
+        fanout_server.session_removed(session)
+        update_session_filter()
+    # The displayed session has been released (KLOC) or has timed out, so there is nothing to show any more.
+    if session.session_id == session_id:
+        logging.debug("Release engine request for session: %d", session.session_id)
+        release_session()
+
 
+session_table = SessionTable(on_session_removed=session_removed)
 
-def process_session_message(session_message: CbusSessionMessage):
-    global session_id, throttle_helper, roster_entry_window
-    if isinstance(session_message, CbusMessageReleaseEngine):
-        logging.debug("Release engine request for session: %d", session_message.session_id)
-        throttle_helper.release()
-        session_id = None
-        if roster_entry_window:
-            roster_entry_window.close()
-    elif isinstance(session_message, CbusMessageEngineReport):
+
+def process_session_message(session_message: CbusSessionMessage, session: Session):
+    if isinstance(session_message, CbusMessageEngineReport):
         logging.debug("Engine report for session: %d", session_message.session_id)
-        update_throttle_helper_from_engine_report(session_message)
+        update_throttle_helper_from_session(session)
     elif isinstance(session_message, CbusMessageSetEngineSpeedDir):
         logging.debug("Speed / direction for session:  %d", session_message.session_id)
-        throttle_helper.speed = session_message.speed
-        throttle_helper.direction = session_message.direction
-        if roster_entry_window:
-            logging.debug("Updating speed, will be %d", throttle_helper.speed)
-            # roster_entry_window["speed"].update(f"Speed: {throttle_helper.speed}")  # TODO: Not working
+        throttle_helper.speed = session.speed
+        throttle_helper.direction = session.direction
     elif isinstance(session_message, CbusMessageSetEngineFunctions):
         logging.debug("Functions for session:  %d", session_message.session_id)
-        throttle_helper.set_function_states(session_message.functions)
+        throttle_helper.functions = session.functions
 
 
 def update_display():
-    logging.debug("Update display")
+    global dirty_since
+    if dirty_since is None:
+        dirty_since = cbus_interface.last_receive_time
+    # Don't paint here: a burst of messages (e.g. DSPD while a knob is being spun) is merged into a single repaint.
+    render_scheduler.mark_dirty()
+
+
+def render_display():
+    global dirty_since
+    start = time.perf_counter()
+    # Only the live state can have changed here; the display skips any element whose value is the same as before.
+    throttle_display.update_state(throttle_helper)
+    throttle_display.refresh()
+    end = time.perf_counter()
+    metrics.record(STAGE_RENDER, end - start)
+    if dirty_since is not None:
+        metrics.record(STAGE_FRAME_TO_PIXEL, end - dirty_since)
+        dirty_since = None
 
 
 def cbus_message_listener(cbus_message: CbusMessage):
-    global pending_address
-    # Check if the current session ID is set.
-    if is_session_set():
-        # Check if this message is a CbusSessionMessage.
-        if isinstance(cbus_message, CbusSessionMessage):
+    # Every message goes to the session table first, so that all sessions on the bus are tracked rather than just the displayed one.
+    session = session_table.process(cbus_message)
+    if session is None:
+        if isinstance(cbus_message, CbusMessageRequestEngineSession) and not is_session_set():
+            prefetch_roster_image(cbus_message.address)
+        return
+    try:
+        # Check if the current session ID is set.
+        if is_session_set():
             # A session is set, so this CbusSessionMessages should only be handled if they match the current session ID.
             if is_session_message_relevant(cbus_message):
                 # The message is relevant, so process it
-                process_session_message(cbus_message)
+                process_session_message(cbus_message, session)
                 update_display()
-    # Session is not set, so if this is a CbusMessageRequestEngineSession, cache the address for later (it will be used for a lookup when the command station replies with a CbusMessageEngineReport).
-    elif isinstance(cbus_message, CbusMessageRequestEngineSession):
-        pending_address = cbus_message.address
-    # Session is not set, so if this message is a CbusMessageEngineReport, set the session ID, and instruct the ThrottleHelper to fetch the roster entry details (using the address we cached previously).
-    elif isinstance(cbus_message, CbusMessageEngineReport):
-        set_session_id(cbus_message.session_id)
-        if pending_address:
-            if cbus_message.address == pending_address:
-                throttle_helper.set_address(pending_address)
-                update_throttle_helper_from_engine_report(cbus_message)
-                display_roster_entry_window()
-                pending_address = None
-            else:
-                logging.error("Received a CbusMessageEngineReport, but address did not match pending address.")
-        else:
-            logging.error("Received a CbusMessageEngineReport, but pending address is not set.")
-
-
-def create_function_grid_item(function_number: int, alternate_bg_colour: bool):
-    global throttle_helper
-    background_colour = "#151515" if alternate_bg_colour else "#1F1F1F"
-    function_label_text = f"F{function_number}"
-    try:
-        function = throttle_helper.get_function(function_number)
-        function_name = sg.Text(f"{function['name']}", expand_x=True, pad=2, background_color=background_colour, font=FONT_VALUE)
-        if not function["lockable"]:
-            function_label_text+= " (mom)"
-    except IndexError:
-        function_name = sg.Text("", background_color=background_colour)
-    function_label = sg.Text(function_label_text, expand_x=True, size=(18,1), pad=2, background_color=background_colour, font=FONT_LABEL)
-    layout = [ [function_label], [function_name]]
-    return sg.Frame(title=None, layout=layout, pad=2, expand_y=True, background_color=background_colour, border_width=0)
-
-
-def prepare_ui():
-    if os.environ.get('DISPLAY','') == '':
-        logging.warning('no display found. Using :0.0')
-        os.environ.__setitem__('DISPLAY', ':0.0')
-    
-    # Set the theme
-    sg.theme('Black')
-    # All the stuff inside your window.
-
-
-def display_home_window():
-    layout = [ [sg.VPush()],
-        [ sg.Push(), sg.Text("No locomotive selected", font=FONT_H2), sg.Push() ],
-        [sg.VPush()] ]
-    home_window = sg.Window(title="Home", layout=layout, no_titlebar=True, location=(0,0), size=(1024,600), margins=(0,0), keep_on_top=True).Finalize()
-
-
-def display_roster_entry_window():
-    global roster_entry_window, throttle_helper
-
-    
-
-    info_items = []
-
-    info_number = sg.Frame(title=None, layout=[[sg.Text("Number", font=FONT_LABEL)], [sg.Text(throttle_helper.roster_entry["number"], size=(8,1), font=FONT_H2)]], pad=0, border_width=0)
-    info_address = sg.Frame(title=None, layout=[[sg.Text("Address", font=FONT_LABEL)], [sg.Text(throttle_helper.roster_entry["dcc_address"], size=(5,1), font=FONT_H2)]], pad=0, border_width=0)
-
-    info_items.append([info_number, info_address])
-    lhs_items = []
-
-    if throttle_helper.roster_entry["name"]:
-        # Use textwrap to ensure the name fits, breaking into multiple lines if necessary
-        for name_piece in textwrap.wrap(throttle_helper.roster_entry["name"], 25):
-            info_items.append([sg.Text(name_piece, font=FONT_H2)])
-    
-    info_height = 600
-    # if throttle_helper.roster_entry["image_file_path"]:
-    try:
-        with Image.open(requests.get(f"https://roster.tomstrains.co.uk/api/v2/roster_entry/{throttle_helper.roster_entry['roster_id']}/image?size=500", stream=True).raw) as image:
-            image_bytes = BytesIO()
-            image.save(image_bytes, format="png")
-            # Calculate the image's aspect ratio, so that was can resize it correctly
-            width, height = image.size
-            aspect_ratio = width / height
-            desired_width = 500
-            desired_height = desired_width / aspect_ratio
-            lhs_items.append([sg.Image(source=image_bytes.getvalue(), size=(desired_width, desired_height), pad=0)])
-            info_height-= desired_height
-    except (FileNotFoundError, UnidentifiedImageError) as e:
-        logging.info(f"Image for roster entry with ID {throttle_helper.roster_entry['roster_id']} not found: {str(e)}")
-    
-
-    info_section = sg.Frame(title=None, layout=info_items, size=(502, info_height), pad=0, border_width=0)
-    lhs_items.insert(0, [info_section])
-
-    lhs = sg.Column(lhs_items, pad=0, size=(502, 600))
+        # Session is not set, so if this message is a CbusMessageEngineReport answering an RLOC, show that session.
+        elif isinstance(cbus_message, CbusMessageEngineReport) and session.requested:
+            switch_session(session.session_id)
+    finally:
+        # Published after the local display has been dealt with, so a problem with a client can never hold it up.
+        if fanout_server:
+            fanout_server.publish(cbus_message, session)
+            # A new session may be for a loco address that a client is subscribed to.
+            if isinstance(cbus_message, CbusMessageEngineReport):
+                update_session_filter()
 
-    functions = [[create_function_grid_item(row + (column * 10), (row + column) % 2 == 0) if row + (column * 10) <= MAX_FUNCTIONS else sg.VPush() for column in range(3)] for row in range(10)]
-    functions_section = sg.Column(functions, expand_y=True, pad=0)
-
-    layout = [  [lhs, functions_section] ]
-    roster_entry_window = sg.Window(title="Hello World", layout=layout, no_titlebar=True, location=(0,0), size=(1024,600), margins=(0,0), keep_on_top=True).Finalize()
-    # Hide the mouse cursor. # TODO: Not working
-    roster_entry_window.set_cursor("none")
 
 # async def test_gui():
 #     global throttle_helper
@@ -232,42 +401,86 @@ def display_roster_entry_window():
 #         await asyncio.sleep(0.1)
 #     window.Close()
 
+def get_session_stats() -> dict:
+    now = session_table.clock()
+    return {
+        "active": len(session_table),
+        "displayed": session_id,
+        # Stats for sessions that have been outside the session filter are partial (see SpeedHistory.pause).
+        "history": {session.session_id: {"address": session.address, "stale": session.stale, **session.history.get_stats(now)} for session in session_table},
+    }
+
+
     # pylint: disable=unused-argument
+def metrics_signal_handler(signum, frame):
+    """Dump metrics to the log on SIGUSR1"""
+    metrics.log_stats()
+
+
+def log_level_signal_handler(signum, frame):
+    """Toggle DEBUG logging on SIGUSR2"""
+    log_config.toggle_debug(LOG_LEVEL)
+
+
 def os_signal_handler(signum, frame):
     """Handle OS signal"""
     logging.debug(f"Received signal from OS ({signum}), shutting down gracefully...")
+    notify("STOPPING=1")
+    session_snapshot.save(session_table, session_id)
     cbus_interface.close()
+    if roster_client:
+        roster_client.close()
+        image_pipeline.close()
+        roster_cache.save_recency()
+    log_config.stop()
     sys.exit()
 
 def DUMMY_manual_load(address: str):
     global throttle_helper
     throttle_helper.set_address(address)
     # update_throttle_helper_from_engine_report(cbus_message)
-    display_roster_entry_window()
+    start_roster_fetch(address)
 
 if __name__ == "__main__":
-    # Set up rich logging.
-    logging.basicConfig(
-        level="DEBUG" if DEBUG else "INFO",
-        format="%(message)s",
-        datefmt="[%X]",
-        handlers=[RichHandler(omit_repeated_times=False)],
-    )
+    # Set up rich logging, written from a background thread so that terminal output never holds up the event loop.
+    log_config = LogConfig(LOG_LEVEL)
 
     # Register a function to be invoked when we receive SIGTERM or SIGHUP.
     # This allows us to act on these events, which are sent when the program execution is halted, or when systemd wants to stop the service.
     signal.signal(signal.SIGINT, os_signal_handler)
     signal.signal(signal.SIGTERM, os_signal_handler)
     signal.signal(signal.SIGHUP, os_signal_handler)
+    signal.signal(signal.SIGUSR1, metrics_signal_handler)
+    signal.signal(signal.SIGUSR2, log_level_signal_handler)
 
     # test_gui()
 
-    cbus_interface = CbusInterface(CAN_INTERFACE, CAN_BITRATE)
+    # The CAN interface is configured on a thread while the window is created, and listening starts as soon as the loop is running.
+    cbus_interface = CbusInterface(CAN_INTERFACE, CAN_BITRATE, CAN_BUSTYPE, CAN_ID)
     loop = asyncio.get_event_loop()
-    loop.create_task(cbus_interface.listen(cbus_message_listener))
-    # loop.create_task(test_gui())
     prepare_ui()
-    display_home_window()
+    throttle_display = ThrottleDisplay()
+    start_roster()
+    loop.create_task(start_listening())
+    if ROSTER_PREFETCH:
+        loop.create_task(refresh_roster_index())
+    # loop.create_task(test_gui())
+    render_scheduler = RenderScheduler(render_display, RENDER_FPS, loop)
+    restore_sessions()
+    loop.create_task(save_sessions())
+    loop.create_task(tick_display())
+    metrics.add_stats_provider("render", render_scheduler.get_stats)
+    metrics.add_stats_provider("reader", lambda: cbus_interface.reader.get_stats() if cbus_interface.reader else {})
+    metrics.add_stats_provider("logging", log_config.get_stats)
+    metrics.add_stats_provider("sessions", get_session_stats)
+    loop.create_task(metrics.serve())
+    if FANOUT_SOCKET_PATH or FANOUT_PORT:
+        fanout_server = FanoutServer(session_table, on_subscriptions_changed=update_session_filter)
+        if FANOUT_SOCKET_PATH:
+            loop.create_task(fanout_server.serve(FANOUT_SOCKET_PATH))
+        if FANOUT_PORT:
+            loop.create_task(fanout_server.serve_tcp(port=FANOUT_PORT))
+        metrics.add_stats_provider("fanout", fanout_server.get_stats)
     # TODO:TEMP
     # DUMMY_manual_load("6957")
     loop.run_forever()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from typing import Callable, Optional
+
+DEFAULT_MAX_FPS = 30
+
+
+class RenderScheduler:
+    """Merges any number of display updates into at most one repaint per frame.
+
+    Callers mark the display as dirty as often as they like (e.g. on every DSPD while a throttle knob is being spun);
+    a single repaint is then scheduled on the asyncio loop, no sooner than one frame after the previous one. Marking the
+    display as dirty never blocks, so CAN reception is never held up by rendering.
+
+    Counters:
+        updates: the number of times the display was marked as dirty.
+        renders: the number of repaints actually made.
+        merged: updates that were folded into a repaint that was already scheduled.
+        dropped: updates that were never painted, because the pending repaint was cancelled or failed."""
+
+    render: Callable[[], None]
+    frame_interval: float
+    loop: asyncio.AbstractEventLoop
+    updates: int
+    renders: int
+    merged: int
+    dropped: int
+    # The number of updates waiting for the scheduled repaint.
+    _pending_updates: int
+    _last_render_time: float
+    _handle: Optional[asyncio.TimerHandle]
+
+    def __init__(self, render: Callable[[], None], max_fps: float = DEFAULT_MAX_FPS, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.render = render
+        self.frame_interval = 1 / max_fps
+        self.loop = loop or asyncio.get_event_loop()
+        self.updates = 0
+        self.renders = 0
+        self.merged = 0
+        self.dropped = 0
+        self._pending_updates = 0
+        self._last_render_time = float("-inf")
+        self._handle = None
+
+    def mark_dirty(self):
+        self.updates += 1
+        self._pending_updates += 1
+        if self._handle is not None:
+            self.merged += 1
+            return
+        delay = max(0, self._last_render_time + self.frame_interval - self.loop.time())
+        self._handle = self.loop.call_later(delay, self._render)
+
+    def cancel(self):
+        """Cancels any scheduled repaint, e.g. because what it would have painted is no longer being displayed."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self.dropped += self._pending_updates
+            self._pending_updates = 0
+
+    def flush(self):
+        """Makes any scheduled repaint immediately."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._render()
+
+    def _render(self):
+        self._handle = None
+        pending_updates = self._pending_updates
+        self._pending_updates = 0
+        self._last_render_time = self.loop.time()
+        try:
+            self.render()
+            self.renders += 1
+        except Exception:
+            self.dropped += pending_updates
+            logging.exception("Error while rendering display")
+
+    def get_stats(self) -> dict:
+        return { "updates": self.updates, "renders": self.renders, "merged": self.merged, "dropped": self.dropped }
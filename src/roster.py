@@ -0,0 +1,171 @@
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from roster_cache import KIND_IMAGE, KIND_ROSTER, KIND_ROSTER_ENTRY, CacheItem, RosterCache
+from roster_index import RosterIndex
+
+ROSTER_API_URL = "https://roster.tomstrains.co.uk/api/v2"
+IMAGE_SIZE = 500
+# The endpoint that lists every roster entry, and the key they are listed under in its response.
+ROSTER_PATH = "/roster_entries"
+ROSTER_ENTRIES_KEY = "roster_entries"
+# The fields of a roster entry that the display can't do without.
+REQUIRED_ROSTER_ENTRY_FIELDS = ("roster_id", "number", "dcc_address", "name")
+
+# How long cached roster entries and images are used without checking with the roster server.
+ROSTER_ENTRY_TTL = 24 * 60 * 60
+IMAGE_TTL = 7 * 24 * 60 * 60
+# What the image methods return for a roster entry that is known to have no image (rather than None, for not known).
+NO_IMAGE = b""
+
+# (connect, read) timeouts in seconds. A slow roster server should never hold up a selection for long.
+REQUEST_TIMEOUT = (3.05, 10)
+RETRIES = 2
+RETRY_BACKOFF_FACTOR = 0.3
+# Requests run on their own small pool of threads, so the asyncio loop (and with it CAN reception) is never blocked.
+MAX_WORKERS = 2
+
+
+class RosterClient:
+    """Fetches roster entries and images from the roster API without blocking the asyncio event loop.
+
+    HTTP is done with a pooled requests Session on a dedicated thread pool; the coroutines can be cancelled like any other
+    (e.g. when a KLOC arrives mid-fetch), in which case the result of the request is discarded."""
+
+    base_url: str
+    cache: Optional[RosterCache]
+    index: Optional[RosterIndex]
+    session: Session
+    executor: ThreadPoolExecutor
+    # The roster response the index was last built from, so that an unchanged roster is not re-parsed.
+    _indexed_roster_bytes: Optional[bytes]
+
+    def __init__(self, base_url: str = ROSTER_API_URL, cache: Optional[RosterCache] = None, index: Optional[RosterIndex] = None):
+        self.base_url = base_url
+        self.cache = cache
+        self.index = index
+        self._indexed_roster_bytes = None
+        self.session = Session()
+        retry = Retry(total=RETRIES, backoff_factor=RETRY_BACKOFF_FACTOR, status_forcelist=(500, 502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="roster")
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+    async def fetch_roster_entry(self, address: int) -> Optional[dict]:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.get_roster_entry, address)
+
+    async def fetch_image(self, roster_id: str) -> Optional[bytes]:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.get_image, roster_id)
+
+    async def fetch_roster_index(self) -> int:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.refresh_index)
+
+    async def load_roster_index(self) -> int:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.load_index_from_cache)
+
+    def load_index_from_cache(self) -> int:
+        """Builds the index from the roster saved by a previous run, however old it is, so lookups work before the roster server has been reached."""
+        cached = self.cache.get(KIND_ROSTER, "all") if self.cache else None
+        return self.update_index(cached.data) if cached else 0
+
+    def refresh_index(self) -> int:
+        """Fetches the whole roster (revalidating any cached copy) and updates the index from it. Returns the number of addresses that changed."""
+        roster_bytes = self.get(KIND_ROSTER, "all", f"{self.base_url}{ROSTER_PATH}", None, 0)
+        return self.update_index(roster_bytes) if roster_bytes else 0
+
+    def update_index(self, roster_bytes: bytes) -> int:
+        if roster_bytes == self._indexed_roster_bytes:
+            return 0
+        try:
+            roster_entries = json.loads(roster_bytes)[ROSTER_ENTRIES_KEY]
+        except (ValueError, KeyError) as e:
+            logging.error("Could not parse roster: %s", str(e))
+            return 0
+        n_changes = self.index.update(roster_entries)
+        self._indexed_roster_bytes = roster_bytes
+        logging.info("Roster index refreshed: %d entries, %d changed", len(self.index), n_changes)
+        return n_changes
+
+    def get_cached_roster_entry(self, address: int) -> Optional[dict]:
+        """Returns the roster entry for an address if it is in the index or there is a fresh copy in the cache, without any network I/O."""
+        roster_entry = self.index.get(address) if self.index else None
+        if roster_entry:
+            return roster_entry
+        cached = self.cache.get(KIND_ROSTER_ENTRY, address) if self.cache else None
+        return self.parse_roster_entry(cached.data) if cached and cached.is_fresh(ROSTER_ENTRY_TTL) else None
+
+    def get_function_index(self, roster_entry: dict) -> Optional[Tuple[Optional[dict], ...]]:
+        """Returns the roster entry's functions as already indexed by the roster index, if that is where it came from."""
+        return self.index.get_functions(roster_entry) if self.index else None
+
+    def get_cached_image(self, roster_id: str) -> Optional[bytes]:
+        """Returns the image for a roster entry (or NO_IMAGE if it is known not to have one) if there is a fresh copy in the
+        cache, without any network I/O."""
+        cached = self.cache.get(KIND_IMAGE, self.get_image_key(roster_id)) if self.cache else None
+        return cached.data if cached and cached.is_fresh(IMAGE_TTL) else None
+
+    def get_roster_entry(self, address: int) -> Optional[dict]:
+        logging.debug("Fetching details for address %s", address)
+        roster_entry_bytes = self.get(KIND_ROSTER_ENTRY, address, f"{self.base_url}/roster_entry/address/{address}", None, ROSTER_ENTRY_TTL)
+        return self.parse_roster_entry(roster_entry_bytes) if roster_entry_bytes else None
+
+    def get_image(self, roster_id: str) -> Optional[bytes]:
+        """Returns the image for a roster entry, NO_IMAGE if it doesn't have one, or None if that can't be found out."""
+        return self.get(KIND_IMAGE, self.get_image_key(roster_id), f"{self.base_url}/roster_entry/{roster_id}/image", {"size": IMAGE_SIZE}, IMAGE_TTL, cache_missing=True)
+
+    def get_image_key(self, roster_id: str) -> str:
+        return f"{roster_id}_{IMAGE_SIZE}"
+
+    def parse_roster_entry(self, roster_entry_bytes: bytes) -> Optional[dict]:
+        """Returns the roster entry in a response, or None (having logged why) if it isn't a usable one."""
+        try:
+            roster_entry = json.loads(roster_entry_bytes)["roster_entry"]
+            missing_fields = [field for field in REQUIRED_ROSTER_ENTRY_FIELDS if field not in roster_entry]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error("Could not parse roster entry: %s", str(e))
+            return None
+        if missing_fields:
+            logging.error("Roster entry is missing %s", ", ".join(missing_fields))
+            return None
+        return roster_entry
+
+    def get(self, kind: str, key, url: str, params: Optional[dict], ttl: float, cache_missing: bool = False) -> Optional[bytes]:
+        """Gets a resource through the cache: fresh items are served without network I/O, stale ones are revalidated with a
+        conditional request, and if the roster server cannot be reached any cached copy is served, however old it is.
+
+        If cache_missing is set, a 404 is cached too, as an empty item, and b"" is returned for it."""
+        cached = self.cache.get(kind, key) if self.cache else None
+        if cached and cached.is_fresh(ttl):
+            return cached.data
+        try:
+            response = self.session.get(url, params=params, headers=cached.get_conditional_headers() if cached else None, timeout=REQUEST_TIMEOUT)
+        except RequestException as e:
+            if cached:
+                logging.warning("Could not reach roster server, using cached %s %s: %s", kind, key, str(e))
+                return cached.data
+            logging.error("Could not fetch %s %s: %s", kind, key, str(e))
+            return None
+        if response.status_code == 304 and cached:
+            self.cache.touch(kind, key, cached)
+            return cached.data
+        if response.status_code == 200:
+            if self.cache:
+                self.cache.put(kind, key, CacheItem(response.content, response.headers.get("ETag"), response.headers.get("Last-Modified")))
+            return response.content
+        if response.status_code == 404 and cache_missing:
+            logging.info("No %s %s", kind, key)
+            if self.cache:
+                self.cache.put(kind, key, CacheItem(b""))
+            return b""
+        logging.error("Could not fetch %s %s (error code %d)", kind, key, response.status_code)
+        return None
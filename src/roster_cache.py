@@ -0,0 +1,213 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Set
+
+CACHE_DIRECTORY = os.path.expanduser("~/.cache/cbus-throttle-display")
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# The most recently used items are also kept in memory, up to this size, so showing a recent loco again reads nothing from the SD card.
+MEMORY_MAX_BYTES = 8 * 1024 * 1024
+
+KIND_ROSTER_ENTRY = "roster_entry"
+KIND_IMAGE = "image"
+KIND_ROSTER = "roster"
+KIND_RENDERED_IMAGE = "rendered_image"
+
+META_SUFFIX = ".meta"
+
+
+class CacheItem:
+
+    __slots__ = ("data", "etag", "last_modified", "fetched_at")
+
+    data: bytes
+    # Validators from the response, used to revalidate the item with a conditional request once it is no longer fresh.
+    etag: str
+    last_modified: str
+    # Wall-clock time (not monotonic, as it must survive restarts) that the item was last fetched or revalidated.
+    fetched_at: float
+
+    def __init__(self, data: bytes, etag: str = None, last_modified: str = None, fetched_at: float = None):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.fetched_at < ttl
+
+    def get_conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class RosterCache:
+    """A size-capped, least-recently-used cache of roster API responses, kept on disk so that it survives restarts.
+
+    Each item is stored as a data file alongside a small JSON metadata file, under a directory per kind of item. The size
+    cap is only kept to within one process, so processes must not share a directory. Recency is tracked in memory, and
+    persisted through the data files' modification times by save_recency() (e.g. at shutdown) rather than being written
+    on every read."""
+
+    directory: str
+    max_bytes: int
+    # Relative path of each data file -> its size in bytes, ordered from least to most recently used.
+    _index: "OrderedDict[str, int]"
+    _total_bytes: int
+    # The most recently used items, least recently used first, and their total size.
+    _memory: "OrderedDict[str, CacheItem]"
+    _memory_bytes: int
+    # Paths read since recency was last saved.
+    _read_paths: Set[str]
+    _lock: threading.Lock
+
+    def __init__(self, directory: str = CACHE_DIRECTORY, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()
+        self._total_bytes = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._read_paths = set()
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def _load_index(self):
+        files = []
+        for kind in (KIND_ROSTER_ENTRY, KIND_IMAGE, KIND_ROSTER, KIND_RENDERED_IMAGE):
+            os.makedirs(os.path.join(self.directory, kind), exist_ok=True)
+            for name in os.listdir(os.path.join(self.directory, kind)):
+                if name.endswith(META_SUFFIX) or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(kind, name)
+                try:
+                    stat = os.stat(os.path.join(self.directory, path))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._index[path] = size
+            self._total_bytes += size
+        logging.debug("Loaded roster cache with %d items (%d bytes)", len(self._index), self._total_bytes)
+
+    def _get_path(self, kind: str, key) -> str:
+        return os.path.join(kind, re.sub(r"[^A-Za-z0-9_-]", "_", str(key)))
+
+    def get(self, kind: str, key) -> Optional[CacheItem]:
+        path = self._get_path(kind, key)
+        with self._lock:
+            if path not in self._index:
+                return None
+            self._index.move_to_end(path)
+            self._read_paths.add(path)
+            item = self._memory.get(path)
+            if item is not None:
+                self._memory.move_to_end(path)
+                return item
+        full_path = os.path.join(self.directory, path)
+        try:
+            with open(full_path, "rb") as data_file:
+                data = data_file.read()
+            with open(full_path + META_SUFFIX, "r") as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError) as e:
+            logging.warning("Discarding unreadable cache item %s: %s", path, str(e))
+            self._remove(path)
+            return None
+        item = CacheItem(data, meta.get("etag"), meta.get("last_modified"), meta.get("fetched_at"))
+        self._remember(path, item)
+        return item
+
+    def _remember(self, path: str, item: CacheItem):
+        with self._lock:
+            previous = self._memory.pop(path, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous.data)
+            if len(item.data) > MEMORY_MAX_BYTES:
+                return
+            self._memory[path] = item
+            self._memory_bytes += len(item.data)
+            while self._memory_bytes > MEMORY_MAX_BYTES:
+                _, forgotten = self._memory.popitem(last=False)
+                self._memory_bytes -= len(forgotten.data)
+
+    def save_recency(self):
+        """Persists the order in which items have been read, as their data files' modification times, so that it survives a restart."""
+        with self._lock:
+            paths = [path for path in self._index if path in self._read_paths]
+            self._read_paths.clear()
+        now = time.time()
+        for i, path in enumerate(paths):
+            # After anything written before now, and spaced out a little so that the order is kept even where the file
+            # system's timestamps are coarse.
+            mtime = now + (i + 1) * 0.01
+            try:
+                os.utime(os.path.join(self.directory, path), (mtime, mtime))
+            except OSError:
+                pass
+
+    def put(self, kind: str, key, item: CacheItem):
+        path = self._get_path(kind, key)
+        full_path = os.path.join(self.directory, path)
+        try:
+            self._write_atomically(full_path, item.data)
+            self._write_meta(full_path, item)
+        except OSError as e:
+            logging.warning("Could not write cache item %s: %s", path, str(e))
+            return
+        with self._lock:
+            self._total_bytes += len(item.data) - self._index.pop(path, 0)
+            self._index[path] = len(item.data)
+        self._remember(path, item)
+        self._evict()
+
+    def touch(self, kind: str, key, item: CacheItem):
+        """Records that an item has just been revalidated, without rewriting its data."""
+        item.fetched_at = time.time()
+        path = self._get_path(kind, key)
+        try:
+            self._write_meta(os.path.join(self.directory, path), item)
+        except OSError as e:
+            logging.warning("Could not update cache item %s: %s", path, str(e))
+
+    def _write_meta(self, full_path: str, item: CacheItem):
+        meta = {"etag": item.etag, "last_modified": item.last_modified, "fetched_at": item.fetched_at}
+        self._write_atomically(full_path + META_SUFFIX, json.dumps(meta).encode())
+
+    def _write_atomically(self, full_path: str, data: bytes):
+        # Write to a temporary file and rename it over the original, so a power cut can never leave a half-written file on the SD card.
+        temp_path = f"{full_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, full_path)
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or len(self._index) <= 1:
+                    return
+                path = next(iter(self._index))
+            logging.debug("Evicting %s from roster cache", path)
+            self._remove(path)
+
+    def _remove(self, path: str):
+        with self._lock:
+            self._total_bytes -= self._index.pop(path, 0)
+            self._read_paths.discard(path)
+            forgotten = self._memory.pop(path, None)
+            if forgotten is not None:
+                self._memory_bytes -= len(forgotten.data)
+        full_path = os.path.join(self.directory, path)
+        for file_path in (full_path, full_path + META_SUFFIX):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
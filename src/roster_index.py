@@ -0,0 +1,60 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+MAX_FUNCTIONS = 28
+
+
+def index_functions(roster_entry: dict) -> Tuple[Optional[dict], ...]:
+    """Returns a roster entry's functions as a tuple with one slot per function number (F0 to F28), None where the loco has no such function."""
+    functions = [None] * (MAX_FUNCTIONS + 1)
+    for function in roster_entry.get("functions") or ():
+        number = function.get("number")
+        if isinstance(number, int) and 0 <= number <= MAX_FUNCTIONS:
+            functions[number] = function
+    return tuple(functions)
+
+
+class RosterIndex:
+    """An in-memory copy of the whole roster, indexed by DCC address, so that a loco can be looked up without any I/O."""
+
+    _entries: Dict[int, dict]
+    _functions: Dict[int, Tuple[Optional[dict], ...]]
+
+    def __init__(self):
+        self._entries = {}
+        self._functions = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, address: int) -> Optional[dict]:
+        return self._entries.get(address)
+
+    def get_functions(self, roster_entry: dict) -> Optional[Tuple[Optional[dict], ...]]:
+        """Returns the already indexed functions of a roster entry (see index_functions), or None if the entry didn't come from this index."""
+        try:
+            address = int(roster_entry["dcc_address"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        return self._functions.get(address) if self._entries.get(address) is roster_entry else None
+
+    def update(self, roster_entries: List[dict]) -> int:
+        """Brings the index in line with a fresh copy of the roster, only re-indexing entries that have changed. Returns the number of addresses added, changed or removed."""
+        n_changes = 0
+        addresses = set()
+        for roster_entry in roster_entries:
+            try:
+                address = int(roster_entry["dcc_address"])
+            except (KeyError, TypeError, ValueError):
+                logging.warning("Ignoring roster entry without a valid DCC address: %s", roster_entry.get("roster_id"))
+                continue
+            addresses.add(address)
+            if self._entries.get(address) != roster_entry:
+                self._functions[address] = index_functions(roster_entry)
+                self._entries[address] = roster_entry
+                n_changes += 1
+        for address in [address for address in self._entries if address not in addresses]:
+            del self._entries[address]
+            del self._functions[address]
+            n_changes += 1
+        return n_changes
@@ -0,0 +1,22 @@
+import os
+import socket
+import logging
+
+
+def notify(*states: str) -> bool:
+    """Sends states (e.g. "READY=1") to systemd, if it started us as a Type=notify service. Returns whether they were sent.
+
+    This is the sd_notify protocol: a datagram of newline-separated assignments sent to the socket named by $NOTIFY_SOCKET."""
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return False
+    # A leading @ means a socket in the abstract namespace.
+    if path.startswith("@"):
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_socket.sendto("\n".join(states).encode(), path)
+        return True
+    except OSError as e:
+        logging.warning(f"Could not notify systemd: {str(e)}")
+        return False
@@ -0,0 +1,97 @@
+import os
+import time
+import struct
+import logging
+from typing import Iterable, List, Optional, Tuple
+from cbus_messages import Direction
+from sessions import Session
+
+# tmpfs, so the snapshot survives the service restarting (which is all it is for) without wearing out the SD card.
+SNAPSHOT_PATH = "/dev/shm/cbus-throttle-display.snapshot"
+SNAPSHOT_INTERVAL = 1.0
+# An unchanged snapshot is still rewritten this often, so that its age says how long ago the process was last running.
+SNAPSHOT_REFRESH_INTERVAL = 60.0
+# Older snapshots than this are ignored, as the sessions in them have almost certainly ended.
+SNAPSHOT_MAX_AGE = 5 * 60.0
+
+MAGIC = b"CBSS"
+VERSION = 4
+# Magic, version, when it was saved (time.time()), displayed session ID (-1 for none), number of sessions.
+HEADER = struct.Struct("<4sBdhH")
+# Session ID, address, speed (-1 for an emergency stop), direction, functions (bit n is Fn).
+# Which functions are known isn't saved: they may have changed while the process was down, so a restored session's
+# functions are only for display until a PLOC or DFUN confirms them (see Session.known_functions).
+RECORD = struct.Struct("<BHbBI")
+
+
+def encode_sessions(sessions: Iterable[Session], displayed_session_id: Optional[int]) -> Tuple[int, bytes]:
+    records = b"".join(RECORD.pack(session.session_id, session.address, session.speed, session.direction, session.functions) for session in sessions)
+    return (-1 if displayed_session_id is None else displayed_session_id), records
+
+
+class SessionSnapshot:
+    """A small binary snapshot of the session table, so the display can carry on where it left off after a restart.
+
+    A snapshot is a HEADER followed by one fixed-size RECORD per session, and is replaced atomically so a reader never sees
+    a partly written one."""
+
+    path: str
+    # What was last written (displayed session ID, records) and when, so an unchanged table isn't rewritten every time.
+    _saved: Optional[Tuple[int, bytes]]
+    _saved_at: float
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = path
+        self._saved = None
+        self._saved_at = float("-inf")
+
+    def save(self, sessions: Iterable[Session], displayed_session_id: Optional[int]):
+        """Writes a snapshot, unless nothing has changed since the last one (and that isn't too old)."""
+        now = time.time()
+        try:
+            snapshot = encode_sessions(sessions, displayed_session_id)
+        except struct.error as e:
+            logging.warning(f"Could not save session snapshot: {str(e)}")
+            return
+        if snapshot == self._saved and now - self._saved_at < SNAPSHOT_REFRESH_INTERVAL:
+            return
+        displayed, records = snapshot
+        temporary_path = f"{self.path}.tmp"
+        try:
+            with open(temporary_path, "wb") as snapshot_file:
+                snapshot_file.write(HEADER.pack(MAGIC, VERSION, now, displayed, len(records) // RECORD.size) + records)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save session snapshot: {str(e)}")
+            return
+        self._saved = snapshot
+        self._saved_at = now
+
+    def load(self, now: float) -> Tuple[List[Session], Optional[int]]:
+        """Returns the sessions in the snapshot (as last seen at now) and the displayed session ID, or nothing if there is no recent snapshot."""
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                data = snapshot_file.read()
+        except FileNotFoundError:
+            return [], None
+        except OSError as e:
+            logging.warning(f"Could not read session snapshot: {str(e)}")
+            return [], None
+        if len(data) < HEADER.size:
+            return [], None
+        magic, version, saved_at, displayed, n_sessions = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or len(data) != HEADER.size + n_sessions * RECORD.size:
+            logging.warning(f"Ignoring invalid session snapshot {self.path}")
+            return [], None
+        age = time.time() - saved_at
+        if not 0 <= age <= SNAPSHOT_MAX_AGE:
+            logging.info(f"Ignoring session snapshot from {age:.0f}s ago")
+            return [], None
+        sessions = []
+        for session_id, address, speed, direction, functions in RECORD.iter_unpack(data[HEADER.size:]):
+            session = Session(session_id, address, now)
+            session.speed = speed
+            session.direction = Direction(direction)
+            session.functions = functions
+            sessions.append(session)
+        return sessions, (None if displayed < 0 else displayed)
@@ -0,0 +1,211 @@
+import time
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, Optional
+from speed_history import SpeedHistory
+from cbus_messages import CbusMessage, CbusMessageEngineReport, CbusMessageReleaseEngine, CbusMessageRequestEngineSession, CbusMessageSetEngineFunctions, CbusMessageSetEngineSpeedDir, CbusSessionMessage, Direction, FunctionState
+
+# How long a session can go without any traffic (including DKEEP keep-alives, which cabs send every few seconds) before it is evicted.
+SESSION_TIMEOUT = 30.0
+# CBUS session IDs are a single byte, so there can never be more than this many sessions.
+MAX_SESSIONS = 256
+# How long an RLOC is remembered while waiting for the command station's PLOC, and how many can be outstanding.
+REQUEST_TIMEOUT = 5.0
+MAX_PENDING_REQUESTS = 32
+
+
+class Session:
+
+    __slots__ = ("session_id", "address", "speed", "direction", "functions", "known_functions", "stale", "requested", "last_seen", "history")
+
+    session_id: int
+    address: int
+    speed: int
+    direction: Direction
+    # Bit n holds the state of function Fn.
+    functions: int
+    # Bit n is set once the state of Fn has been seen (a PLOC only reports F0 to F12, so the others are unknown until a DFUN for them).
+    known_functions: int
+    # Set once DSPD and DFUN for the session stop being received (see SessionTable.set_tracked), until a DSPD or PLOC brings its speed up to date.
+    stale: bool
+    # Whether the session was created in response to an RLOC we saw, rather than e.g. a session being shared or stolen.
+    requested: bool
+    last_seen: float
+    history: SpeedHistory
+
+    def __init__(self, session_id: int, address: int, last_seen: float):
+        self.session_id = session_id
+        self.address = address
+        self.speed = 0
+        self.direction = Direction.FORWARD
+        self.functions = 0
+        self.known_functions = 0
+        self.stale = False
+        self.requested = False
+        self.last_seen = last_seen
+        self.history = SpeedHistory()
+
+    def get_function_state(self, function_number: int) -> FunctionState:
+        return (self.functions >> function_number) & 0x01
+
+    def apply_functions(self, functions: int, function_mask: int):
+        """Sets the functions in function_mask to the states in functions (both bitmasks, bit n for Fn), leaving the others as they were."""
+        self.functions = (self.functions & ~function_mask) | functions
+        self.known_functions |= function_mask
+
+    def mark_stale(self, now: float):
+        """Records that changes to the session have stopped being received. Its speed can no longer be trusted, and its
+        function states are forgotten, so they are never shown or sent as current; DFUN and PLOC fill them in again.
+        Its speed history stops counting time moving, and its stats are reported as partial."""
+        self.stale = True
+        self.functions = 0
+        self.known_functions = 0
+        self.history.pause(now)
+
+
+class SessionTable:
+    """Tracks the state of every active session on the bus, keyed by session ID."""
+
+    timeout: float
+    max_sessions: int
+    clock: Callable[[], float]
+    on_session_removed: Optional[Callable[[Session], None]]
+    # The sessions whose DSPD and DFUN are being received, or None for all of them (see set_tracked).
+    tracked_session_ids: Optional[FrozenSet[int]]
+    # Ordered from least to most recently seen, so stale sessions are always at the front.
+    _sessions: "OrderedDict[int, Session]"
+    _sessions_by_address: Dict[int, Session]
+    _pending_requests: "OrderedDict[int, float]"
+
+    def __init__(self, timeout: float = SESSION_TIMEOUT, max_sessions: int = MAX_SESSIONS, clock: Callable[[], float] = time.monotonic, on_session_removed: Optional[Callable[[Session], None]] = None):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self.on_session_removed = on_session_removed
+        self.tracked_session_ids = None
+        self._sessions = OrderedDict()
+        self._sessions_by_address = {}
+        self._pending_requests = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self) -> Iterator[Session]:
+        return iter(list(self._sessions.values()))
+
+    def get(self, session_id: int) -> Optional[Session]:
+        return self._sessions.get(session_id)
+
+    def get_by_address(self, address: int) -> Optional[Session]:
+        return self._sessions_by_address.get(address)
+
+    def set_tracked(self, session_ids: Optional[Iterable[int]]):
+        """Records that DSPD and DFUN are only being received for these sessions (None for all of them, e.g. see
+        CbusInterface.set_session_filter). Every other session is marked stale."""
+        self.tracked_session_ids = None if session_ids is None else frozenset(session_ids)
+        if self.tracked_session_ids is None:
+            return
+        now = self.clock()
+        for session in self._sessions.values():
+            if not session.stale and session.session_id not in self.tracked_session_ids:
+                session.mark_stale(now)
+
+    def is_tracked(self, session_id: int) -> bool:
+        return self.tracked_session_ids is None or session_id in self.tracked_session_ids
+
+    def is_address_requested(self, address: int) -> bool:
+        return address in self._pending_requests
+
+    def process(self, cbus_message: CbusMessage) -> Optional[Session]:
+        """Applies a message to the table, returning the session it concerned (for a KLOC, the session that was removed), or None if it concerned no known session."""
+        now = self.clock()
+        self.evict_stale(now)
+        if isinstance(cbus_message, CbusSessionMessage):
+            if isinstance(cbus_message, CbusMessageEngineReport):
+                return self._process_engine_report(cbus_message, now)
+            session = self._sessions.get(cbus_message.session_id)
+            if session is None:
+                return None
+            if isinstance(cbus_message, CbusMessageReleaseEngine):
+                self.remove(cbus_message.session_id)
+                return session
+            session.last_seen = now
+            self._sessions.move_to_end(session.session_id)
+            if isinstance(cbus_message, CbusMessageSetEngineSpeedDir):
+                session.speed = cbus_message.speed
+                session.direction = cbus_message.direction
+                session.stale = False
+                session.history.record(now, session.speed, session.direction)
+            elif isinstance(cbus_message, CbusMessageSetEngineFunctions):
+                session.apply_functions(cbus_message.functions, cbus_message.function_mask)
+            return session
+        elif isinstance(cbus_message, CbusMessageRequestEngineSession):
+            self._pending_requests.pop(cbus_message.address, None)
+            self._pending_requests[cbus_message.address] = now
+            if len(self._pending_requests) > MAX_PENDING_REQUESTS:
+                self._pending_requests.popitem(last=False)
+        return None
+
+    def _process_engine_report(self, engine_report: CbusMessageEngineReport, now: float) -> Session:
+        session = self._sessions.get(engine_report.session_id)
+        if session is not None and session.address != engine_report.address:
+            # The command station has reused the session ID for a different loco, so the old session must have ended.
+            self.remove(session.session_id)
+            session = None
+        if session is None:
+            # A loco can only be in one session at a time, so any other session for this address is stale.
+            existing_session = self._sessions_by_address.get(engine_report.address)
+            if existing_session is not None:
+                self.remove(existing_session.session_id)
+            if len(self._sessions) >= self.max_sessions:
+                self.remove(next(iter(self._sessions)))
+            session = Session(engine_report.session_id, engine_report.address, now)
+            self._sessions[session.session_id] = session
+            self._sessions_by_address[session.address] = session
+        else:
+            session.last_seen = now
+            self._sessions.move_to_end(session.session_id)
+        if self._pending_requests.pop(engine_report.address, None) is not None:
+            session.requested = True
+        session.speed = engine_report.speed
+        session.direction = engine_report.direction
+        session.history.record(now, session.speed, session.direction)
+        # A PLOC only reports F0 to F12, so any higher functions are left as they were.
+        session.apply_functions(engine_report.functions, engine_report.function_mask)
+        session.stale = False
+        # Up to date for now, but nothing more will be heard about a session that isn't being tracked.
+        if not self.is_tracked(session.session_id):
+            session.mark_stale(now)
+        return session
+
+    def restore(self, session: Session):
+        """Adds a session recovered after a restart (see SessionSnapshot). Its last_seen should be the time of the restart, so
+        that it is evicted as normal if the bus never confirms it, and any DSPD or DFUN that arrives simply updates it."""
+        if session.session_id in self._sessions or session.address in self._sessions_by_address or len(self._sessions) >= self.max_sessions:
+            return
+        self._sessions[session.session_id] = session
+        self._sessions_by_address[session.address] = session
+
+    def remove(self, session_id: int) -> Optional[Session]:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._sessions_by_address.pop(session.address, None)
+            if self.on_session_removed:
+                self.on_session_removed(session)
+        return session
+
+    def evict_stale(self, now: Optional[float] = None):
+        """Removes sessions that have not been seen within the timeout. Only the oldest entries are examined, so this is cheap to call on every message."""
+        if now is None:
+            now = self.clock()
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_seen < self.timeout:
+                break
+            logging.debug("Evicting stale session %d (address %d)", session.session_id, session.address)
+            self.remove(session.session_id)
+        while self._pending_requests:
+            address, requested_at = next(iter(self._pending_requests.items()))
+            if now - requested_at < REQUEST_TIMEOUT:
+                break
+            del self._pending_requests[address]
@@ -0,0 +1,124 @@
+from array import array
+from typing import List, Optional
+from cbus_messages import Direction
+
+# Speed steps kept per session. Only changes are recorded, so this is many minutes of even very busy driving.
+HISTORY_CAPACITY = 1024
+
+
+class SpeedHistory:
+    """A fixed-capacity ring buffer of timestamped speed steps for one session, with running stats.
+
+    Samples are held in preallocated arrays, so recording one never allocates, and once full the oldest are overwritten.
+    The stats cover the whole life of the session, not just what is still in the buffer."""
+
+    __slots__ = ("capacity", "times", "speeds", "directions", "count", "_next",
+        "max_speed", "direction_changes", "partial", "_time_moving", "_last_time", "_last_speed", "_last_direction")
+
+    capacity: int
+    times: array
+    speeds: array
+    directions: array
+    # How many samples are in the buffer, and where the next one goes.
+    count: int
+    _next: int
+    max_speed: int
+    direction_changes: int
+    # Set once any changes may have been missed (see pause), so the stats are lower bounds.
+    partial: bool
+    # Time spent moving up to _last_time; the time since then is added on when asked for.
+    _time_moving: float
+    _last_time: Optional[float]
+    _last_speed: int
+    _last_direction: Optional[Direction]
+
+    def __init__(self, capacity: int = HISTORY_CAPACITY):
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.speeds = array("b", bytes(capacity))
+        self.directions = array("B", bytes(capacity))
+        self.count = 0
+        self._next = 0
+        self.max_speed = 0
+        self.direction_changes = 0
+        self.partial = False
+        self._time_moving = 0.0
+        self._last_time = None
+        self._last_speed = 0
+        self._last_direction = None
+
+    def record(self, now: float, speed: int, direction: Direction):
+        """Records the speed and direction as of now. Repeats of the last step are ignored, apart from advancing the stats."""
+        if self._last_time is not None and self._last_speed > 0:
+            self._time_moving += now - self._last_time
+        self._last_time = now
+        if speed == self._last_speed and direction == self._last_direction:
+            return
+        if self._last_direction is not None and direction != self._last_direction:
+            self.direction_changes += 1
+        if speed > self.max_speed:
+            self.max_speed = speed
+        self._last_speed = speed
+        self._last_direction = direction
+        index = self._next
+        self.times[index] = now
+        self.speeds[index] = speed
+        self.directions[index] = direction
+        self._next = (index + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def pause(self, now: float):
+        """Stops the clock as of now, for when changes stop being received: until the next sample, the loco is not counted
+        as moving, however it was last seen."""
+        if self._last_time is not None and self._last_speed > 0:
+            self._time_moving += now - self._last_time
+        self._last_time = None
+        self.partial = True
+
+    def get_index(self, i: int) -> int:
+        """Returns where the i-th oldest sample is in the arrays."""
+        return (self._next - self.count + i) % self.capacity
+
+    def find(self, time: float) -> int:
+        """Returns the number of samples recorded at or before time (so the one in force at time is that number less one)."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self.get_index(middle)] <= time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get_time_moving(self, now: float) -> float:
+        return self._time_moving + (now - self._last_time if self._last_time is not None and self._last_speed > 0 else 0.0)
+
+    def get_stats(self, now: float) -> dict:
+        return {
+            "max_speed": self.max_speed,
+            "time_moving_s": self.get_time_moving(now),
+            "direction_changes": self.direction_changes,
+            "samples": self.count,
+            "partial": self.partial,
+        }
+
+    def downsample(self, start: float, end: float, n_buckets: int) -> List[Optional[int]]:
+        """Returns the speed over [start, end) in n_buckets equal slices: the highest speed held at any point in each slice,
+        or None for slices from before the oldest sample still in the buffer."""
+        buckets = [None] * n_buckets
+        if n_buckets <= 0 or end <= start:
+            return buckets
+        bucket_width = (end - start) / n_buckets
+        i = self.find(start)
+        speed = self.speeds[self.get_index(i - 1)] if i > 0 else None
+        for bucket in range(n_buckets):
+            bucket_end = start + (bucket + 1) * bucket_width
+            highest = speed
+            while i < self.count and self.times[self.get_index(i)] < bucket_end:
+                speed = self.speeds[self.get_index(i)]
+                if highest is None or speed > highest:
+                    highest = speed
+                i += 1
+            buckets[bucket] = highest
+        return buckets
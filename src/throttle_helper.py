@@ -1,53 +1,62 @@
-from audioop import add
 import logging
-from typing import List
-from cbus_messages import Function, Direction
-from requests import get, Response
-import json
+from typing import Optional, Tuple
+from cbus_messages import Direction, FunctionState
+from roster_index import MAX_FUNCTIONS, index_functions
+from speed_history import SpeedHistory
 
-MAX_FUNCTIONS = 28
+EMPTY_FUNCTION_INDEX = (None,) * (MAX_FUNCTIONS + 1)
 
 class ThrottleHelper:
 
-    # _address: int
-    roster_entry: dict = None
-    speed: int = None
-    direction: Direction = None
-    functions: dict = {}
+    address: int
+    roster_entry: dict
+    # The roster entry's functions, one slot per function number, so they can be looked up without scanning the list.
+    function_index: Tuple[Optional[dict], ...]
+    speed: int
+    direction: Direction
+    # Bit n holds the state of function Fn.
+    functions: int
+    # The speed history of the session being shown, if there is one.
+    history: Optional[SpeedHistory]
+
+    def __init__(self):
+        self.address = None
+        self.roster_entry = None
+        self.function_index = EMPTY_FUNCTION_INDEX
+        self.speed = None
+        self.direction = None
+        self.functions = 0
+        self.history = None
 
     def set_address(self, address: int):
-        # TODO: Fetch from roster API.
-        logging.debug("Fetching details for address %s", address)
-        roster_entry_response = get(f"https://roster.tomstrains.co.uk/api/v2/roster_entry/address/{address}")
-        if roster_entry_response.status_code == 200:
-            self.process_roster_entry_response(roster_entry_response)
-        else:
-            logging.error("Could not fetch roster entry with address %d (error code %d)", address, roster_entry_response.status_code)
-    
-    def process_roster_entry_response(self, roster_entry_response: Response):
-        self.roster_entry = roster_entry_response.json()["roster_entry"]
-        # logging.debug(json.dumps(self.roster_entry, indent=4))
+        # The roster entry is fetched separately (see RosterClient), so until it arrives only the address is known.
+        self.address = address
+        self.roster_entry = None
+        self.function_index = EMPTY_FUNCTION_INDEX
+
+    def set_roster_entry(self, roster_entry: dict, function_index: Optional[Tuple[Optional[dict], ...]] = None):
+        """Sets the roster entry, along with its functions if they have already been indexed (e.g. by RosterIndex)."""
+        self.roster_entry = roster_entry
+        self.function_index = function_index if function_index is not None else index_functions(roster_entry)
 
 
     def release(self):
+        self.address = None
         self.roster_entry = None
+        self.function_index = EMPTY_FUNCTION_INDEX
         self.speed = None
         self.direction = None
-        self.functions.clear()
+        self.functions = 0
+        self.history = None
         logging.debug("Released")
 
     
-    def get_function(self, function_number: int) -> dict:
-        for i in range(MAX_FUNCTIONS):
-            try:
-                function = self.roster_entry["functions"][i]
-                if function["number"] == function_number:
-                    return function
-            except IndexError:
-                pass
-        raise IndexError
+    def get_function(self, function_number: int) -> Optional[dict]:
+        """Returns the roster entry's function with the given number, or None if it does not have one."""
+        if 0 <= function_number <= MAX_FUNCTIONS:
+            return self.function_index[function_number]
+        return None
 
     
-    def set_function_states(self, functions: List[Function]):
-        for function in functions:
-            self.functions[function.number] = function.state
+    def get_function_state(self, function_number: int) -> FunctionState:
+        return (self.functions >> function_number) & 0x01